@@ -6,16 +6,50 @@
 # of the NIST proposed post-quantum cryptosystem: https://csrc.nist.gov/Projects/Post-Quantum-Cryptography/Round-1-Submissions
 # - Creates the public and private keys, encrypts and decrypts a 32-byte message
 #
-# To run: python main.py <debug>
+# To run: python main.py [debug|selftest|bench|bench-ntt|bench-batch|bench-sample|bench-pool|
+#                         bench-async|bench-stream|bench-fused|bench-compress|bench-params|
+#                         bench-keystore|bench-poly|bench-startup]
+#         python main.py bench --params NewHope512
+#         python main.py failure-rate --trials 1000000 --out failures.jsonl
+#         python main.py bench --iterations 500 --json bench.json
+#         python main.py serve --port 8765   (then: python main.py loadgen --port 8765)
+#         python main.py keygen pk.bin sk.bin; python main.py encrypt-stream pk.bin in out
 
 
 import logging
 import os
 import sys
+import argparse
+import io
+import asyncio
 import hashlib
+import hmac
+import json
+import math
+import mmap
+import platform
+import struct
+import subprocess
 import random
+import time
+import tracemalloc
+import tempfile
 from logging import debug, warning, info
 import datetime as dt
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from collections import OrderedDict, Counter, deque
+
+try:
+    import numpy as np
+except ImportError:     # NumPy is optional, the pure-Python backend is used without it
+    np = None
+
+try:
+    import resource
+except ImportError:     # only used to report the peak RSS, which is not available on Windows
+    resource = None
 
 NEWHOPE_N = 1024      # Security level of 233 (sect. 1.3 of NewHope supporting document)
 NEWHOPE_N_INV = 12277   # inverse of n
@@ -23,210 +57,356 @@ NEWHOPE_7N_4 = 1792     # 7n/4
 NEWHOPE_3N_8 = 384      # 3n/4
 NEWHOPE_Q = 12289     # Smallest prime st. q = 1 (mod 2n) so that NTT can be realized efficiently (sect. 1.3)
 NEWHOPE_K  =8         # Distribution of RLWE secret using centered binomial distribution of parameter k=8 (sect. 1.3)
-NEWHOPE_ROOT = 10302    # square root of nth root of unity
+NEWHOPE_ROOT = 10302    # primitive nth root of unity (its square root psi = 1945 is used by the negacyclic NTT)
 SQUEEZE_BLOCK_SIZE = 168    # block size of SHAKE output
+PK_CACHE_SIZE = 128         # number of prepared public keys kept by Encrypt
 
-# # Precomputed powers of nth root of unity
-# psi_bitrev = [8193, 493, 6845, 9908, 1378, 10377, 7952, 435, 10146, 1065, 404, 7644, 1207, 3248, 11121, 5277, 2437, 3646, 2987, 6022, 9867, 6250, 10102, 9723, 1002, 7278, 4284, 7201,
-#     875, 3780, 1607, 4976, 8146, 4714, 242, 1537, 3704, 9611, 5019, 545, 5084, 10657, 4885, 11272, 3066, 12262, 3763, 10849, 2912, 5698, 11935, 4861, 7277, 9808, 11244, 2859,
-#     7188, 1067, 2401, 11847, 390, 11516, 8511, 3833, 2780, 7094, 4895, 1484, 2305, 5042, 8236, 2645, 7875, 9442, 2174, 7917, 1689, 3364, 4057, 3271, 10863, 4654, 1777, 10626,
-#     3636, 7351, 9585, 6998, 160, 3149, 4437, 12286, 10123, 3915, 7370, 12176, 4048, 2249, 2884, 1153, 9103, 6882, 2126, 10659, 3510, 5332, 2865, 9919, 9320, 8311, 9603, 9042,
-#     3016, 12046, 9289, 11618, 7098, 3136, 9890, 3400, 2178, 1544, 5559, 420, 8304, 4905, 476, 3531, 9326, 4896, 9923, 3051, 3091, 81, 1000, 4320, 1177, 8034, 9521, 10654, 11563,
-#     7678, 10436, 12149, 3014, 9088, 5086, 1326, 11119, 2319, 11334, 790, 2747, 7443, 3135, 3712, 1062, 9995, 7484, 8736, 9283, 2744, 11726, 2975, 9664, 949, 7468, 9650, 7266,
-#     5828, 6561, 7698, 3328, 6512, 1351, 7311, 8155, 5736, 722, 10984, 4043, 7143, 10810, 1, 8668, 2545, 3504, 8747, 11077, 1646, 9094, 5860, 1759, 8582, 3694, 7110, 8907, 11934,
-#     8058, 9741, 9558, 3932, 5911, 4890, 3637, 8830, 5542, 12144, 5755, 7657, 7901, 11029, 11955, 9863, 10861, 1696, 3284, 2881, 7197, 2089, 9000, 2013, 729, 9048, 11809, 2842,
-#     11267, 9, 6498, 544, 2468, 339, 1381, 2525, 8112, 3584, 6958, 4989, 10616, 8011, 5374, 9452, 12159, 4354, 9893, 7837, 3296, 8340, 7222, 2197, 118, 2476, 5767, 827, 8541,
-#     11336, 3434, 3529, 2908, 12071, 2361, 1843, 3030, 8174, 6147, 9842, 8326, 576, 10335, 10238, 10484, 9407, 11836, 5908, 418, 3772, 7515, 5429, 7552, 10996, 12133, 2767, 3969,
-#     8298, 6413, 10008, 2031, 5333, 10800, 9789, 10706, 5942, 1263, 49, 5915, 10806, 11939, 10777, 1815, 5383, 3202, 4493, 6920, 10232, 1975, 8532, 2925, 347, 4754, 1858, 11863,
-#     8974, 9551, 5868, 9634, 5735,11566, 12115, 10596, 3009, 6190, 11994, 6523, 652, 3762, 9370, 4016, 4077, 8561, 4049, 5990, 11130, 11143, 948, 325, 1404, 6992, 6119, 8333,
-#     10929, 1200, 5184, 2555, 6122, 1594, 10327, 7183, 5961, 2692, 12121, 4298, 3329, 5919, 4433, 8455,7032, 1747, 3123, 3054, 6803, 5782, 10723, 9341, 2503, 683, 2459, 3656,
-#     64, 4240, 3570, 835, 6065, 4046, 11580, 10970, 3150, 10331, 4322, 2078, 1112, 4079, 11231, 441, 922, 1050, 4536, 6844, 8429, 2683, 11099, 3818, 6171, 8500, 12142, 6833, 4449,
-#     4749, 6752, 7500, 7822, 8214, 6974, 7965, 7373, 2169, 522, 5079, 3262, 10316, 6715, 1278, 9945, 3514, 11248, 11271, 5925, 468, 3988, 382, 11973, 5339, 6843, 6196, 8579, 2033,
-#     8291, 1922, 3879, 11035, 973, 6854, 10930, 5206, 6760, 3199, 56, 3565, 654, 1702, 10302, 5862, 6153, 5415, 8646, 11889, 10561, 7341, 6152, 7232, 4698, 8844, 4780, 10240, 4912,
-#     1321, 12097, 7048, 2920, 3127, 4169, 11502, 3482, 11279, 5468, 5874, 11612, 6055, 8953, 52, 3174, 10966, 9523, 151, 2127, 3957, 2839, 9784, 6383, 1579, 431, 7507, 5886, 3029,
-#     6695, 4213, 504, 11684, 2302, 8689, 9026, 4624, 6212, 11868, 4080, 6221, 8687, 1003, 8757, 241, 58, 5009, 10333, 885, 6281, 3438, 9445, 11314, 8077, 6608, 3477, 142, 1105,
-#     8841, 343, 4538, 1908, 1208, 4727, 7078, 10423, 10125, 6873, 11573, 10179, 416, 814, 1705, 2450, 8700, 717, 9307, 1373, 8186, 2429, 10568, 10753, 7228, 11071, 438, 8774, 5993,
-#     3278, 4209, 6877, 3449, 1136, 3708, 3238, 2926, 1826, 4489, 3171, 8024, 8611, 1928, 464, 3205, 8930, 7080, 1092, 10900, 10221, 11943, 4404, 9126, 4032, 7449, 6127, 8067, 10763,
-#     125, 540, 8921, 8062, 612, 8051, 12229, 9572, 9089, 10754, 10029, 68, 6453, 7723, 4781, 4924, 1014, 448, 3942, 5232, 1327, 8682, 3744, 7326, 3056, 9761, 5845, 5588, 412, 7187,
-#     3975, 4883, 3087, 6454, 2257, 7784, 5676, 1417, 8400, 11710, 5596, 5987, 9175, 2769, 5966, 212, 6555, 11113, 5508, 11014, 1125, 4860, 10844, 1131, 4267, 6636, 2275, 9828, 5063,
-#     4176, 3765, 1518, 8794, 4564, 10224, 5826, 3534, 3961, 4145, 10533, 506, 11034, 6505, 10897, 2674, 10077, 3338, 9013, 3511, 6811, 11111, 2776, 1165, 2575, 8881, 10347, 377,
-#     4578, 11914, 10669, 10104, 392, 10453, 425, 9489, 193, 2231, 6197, 1038, 11366, 6204, 8122, 2894, 3654, 10975, 10545, 6599, 2455, 11951, 3947, 20, 5002, 5163, 4608, 8946, 8170,
-#     10138, 1522, 8665, 10397, 3344, 5598, 10964, 6565, 11260, 1945, 11041, 9847, 7174, 4939, 2148, 6330, 3959, 5797, 4913, 3528, 8054, 3825, 8914, 9998, 4335, 8896, 9342, 3982,
-#     6680, 11653, 7790, 6617, 1737, 622, 10485, 10886, 6195, 7100, 1687, 406, 12143, 5268, 9389, 12050, 994, 7735, 5464, 7383, 4670, 512, 364, 9929, 3028, 5216, 5518, 1226, 7550,
-#     8038, 7043, 7814, 11053, 3017, 3121, 7584, 2600, 11232, 6780, 12085, 5219, 1409, 9600, 4605, 8151, 12109, 463, 8882, 8308, 10821, 9247, 10945, 9806, 2054, 6203, 6643, 3120,
-#     6105, 8348, 8536, 6919, 8753, 11007, 8717, 9457, 2021, 9060, 4730, 3929, 10583, 3723, 845, 1936, 7, 5054, 3154, 3285, 4360, 3805, 11522, 2213, 4153, 12239, 12073, 5526, 769,
-#     4099, 3944, 5604, 5530, 11024, 9282, 2171, 3480, 7434, 8520, 3232, 11996, 9656, 1406, 2945, 5349, 7207, 4590, 11607, 11309, 5202, 844, 7082, 4050, 8016, 9068, 9694, 8452, 7000,
-#     5662, 567, 2941, 8619, 3808, 4987, 2373, 5135, 63, 7605, 3360, 11839, 10345, 578, 6921, 7628, 510, 5386, 2622, 7806, 5703, 10783, 9224, 11379, 5900, 4719, 11538, 3502, 5789,
-#     10631, 5618, 826, 5043, 3090, 10891, 9951, 7596, 2293, 11872, 6151, 3469, 4443, 8871, 1555, 1802, 5103, 1891, 1223, 2334, 7878, 1590, 881, 365, 1927, 11274, 4510, 9652, 2946,
-#     6828, 1280, 614, 10918, 12265, 7250, 6742, 9804, 11385, 2276, 11307, 2593, 879, 7899, 8071, 3454, 8531, 3795, 9021, 5776, 1849, 7766, 7988, 457, 8, 530, 9663, 7785, 11511, 3578,
-#     7592, 10588, 3466, 8972, 9757, 3332, 139, 2046, 2940, 10808, 9332, 874, 2301, 5650, 12119, 150, 648, 8000, 9982, 9416, 2827, 2434, 11498, 6481, 12268, 9754, 11169, 11823, 11259,
-#     3821, 10608, 2929, 6263, 4649, 6320, 9687, 10388, 502, 5118, 8496, 6226, 10716, 8443, 7624, 6883, 9269, 6616, 8620, 5287, 944, 7519, 6125, 1882, 11249, 10254, 5410, 1251, 1790,
-#     5275, 8449, 10447, 4113, 72, 2828, 4352, 7455, 2712, 11048, 7911, 3451, 4094, 6508, 3045, 11194, 2643, 1783, 7211, 4974, 7724, 9811, 9449, 3019, 4194, 2730, 6878, 10421, 2253,
-#     4518, 9195, 7469, 11129, 9173, 12100, 1763, 2209, 9617, 5170, 865, 1279, 1694, 10759, 8420, 4423, 10555, 3815, 5832, 10939]
-# psi_bitrev_inv = [8193, 11796, 2381, 5444, 11854, 4337, 1912, 10911, 7012, 1168, 9041, 11082, 4645, 11885, 11224, 2143, 7313, 10682, 8509, 11414, 5088, 8005, 5011, 11287, 2566, 2187, 6039, 2422,
-#     6267, 9302, 8643, 9852, 8456, 3778, 773, 11899, 442, 9888, 11222, 5101, 9430, 1045, 2481, 5012, 7428, 354, 6591, 9377, 1440, 8526, 27, 9223, 1017, 7404, 1632, 7205, 11744, 7270,
-#     2678, 8585, 10752, 12047, 7575, 4143, 8758, 11813, 7384, 3985, 11869, 6730, 10745, 10111, 8889, 2399, 9153, 5191, 671, 3000, 243, 9273, 3247, 2686, 3978, 2969, 2370, 9424, 6957,
-#     8779, 1630, 10163, 5407, 3186, 11136, 9405, 10040, 8241, 113, 4919, 8374, 2166, 3, 7852, 9140, 12129, 5291, 2704, 4938, 8653, 1663, 10512, 7635, 1426, 9018, 8232, 8925, 10600, 4372,
-#     10115, 2847, 4414, 9644, 4053, 7247, 9984, 10805, 7394, 5195, 9509, 953, 3748, 11462, 6522, 9813, 12171, 10092, 5067, 3949, 8993, 4452, 2396, 7935, 130, 2837, 6915, 4278, 1673, 7300,
-#     5331, 8705, 4177, 9764, 10908, 11950, 9821, 11745, 5791, 12280, 1022, 9447, 480, 3241, 11560, 10276, 3289, 10200, 5092, 9408, 9005, 10593, 1428, 2426, 334, 1260, 4388, 4632, 6534,
-#     145, 6747, 3459, 8652, 7399, 6378, 8357, 2731, 2548, 4231, 355, 3382, 5179, 8595, 3707, 10530, 6429, 3195, 10643, 1212, 3542, 8785, 9744, 3621, 12288, 1479, 5146, 8246, 1305, 11567,
-#     6553, 4134, 4978, 10938, 5777, 8961, 4591, 5728, 6461, 5023, 2639, 4821, 11340, 2625, 9314, 563, 9545, 3006, 3553, 4805, 2294, 11227, 8577, 9154, 4846, 9542, 11499, 955, 9970, 1170,
-#     10963, 7203, 3201, 9275, 140, 1853, 4611, 726, 1635, 2768, 4255, 11112, 7969, 11289, 12208, 9198, 9238, 2366, 7393, 2963, 11184, 12147, 8812, 5681, 4212, 975, 2844, 8851, 6008, 11404,
-#     1956, 7280, 12231, 12048, 3532, 11286, 3602, 6068, 8209, 421, 6077, 7665, 3263, 3600, 9987, 605, 11785, 8076, 5594, 9260, 6403, 4782, 11858, 10710, 5906, 2505, 9450, 8332, 10162,
-#     12138, 2766, 1323, 9115, 12237, 3336, 6234, 677, 6415, 6821, 1010, 8807, 787, 8120, 9162, 9369, 5241, 192, 10968, 7377, 2049, 7509, 3445, 7591, 5057, 6137, 4948, 1728, 400, 3643,
-#     6874, 6136, 6427, 1987, 10587, 11635, 8724, 12233, 9090, 5529, 7083, 1359, 5435, 11316, 1254, 8410, 10367, 3998, 10256, 3710, 6093, 5446, 6950, 316, 11907, 8301, 11821, 6364, 1018,
-#     1041, 8775, 2344, 11011, 5574, 1973, 9027, 7210, 11767, 10120, 4916, 4324, 5315, 4075, 4467, 4789, 5537, 7540, 7840, 5456, 147, 3789, 6118, 8471, 1190, 9606, 3860, 5445, 7753, 11239,
-#     11367, 11848, 1058, 8210, 11177, 10211, 7967, 1958, 9139, 1319, 709, 8243, 6224, 11454, 8719, 8049, 12225, 8633, 9830, 11606, 9786, 2948, 1566, 6507, 5486, 9235, 9166, 10542, 5257,
-#     3834, 7856, 6370, 8960, 7991, 168, 9597, 6328, 5106, 1962, 10695, 6167, 9734, 7105, 11089, 1360, 3956, 6170, 5297, 10885, 11964, 11341, 1146, 1159, 6299, 8240, 3728, 8212, 8273, 2919,
-#     8527, 11637, 5766, 295, 6099, 9280, 1693, 174, 723, 6554, 2655, 6421, 2738, 3315, 426, 10431, 7535, 11942, 9364, 3757, 10314, 2057, 5369, 7796, 9087, 6906, 10474, 1512, 350, 1483,
-#     6374, 12240, 11026, 6347, 1583, 2500, 1489, 6956, 10258, 2281, 5876, 3991, 8320, 9522, 156, 1293, 4737, 6860, 4774, 8517, 11871, 6381, 453, 2882, 1805, 2051, 1954, 11713, 3963, 2447,
-#     6142, 4115, 9259, 10446, 9928, 218, 9381, 8760, 8855, 1350, 6457, 8474, 1734, 7866, 3869, 1530, 10595, 11010, 11424, 7119, 2672, 10080, 10526, 189, 3116, 1160, 4820, 3094, 7771, 10036,
-#     1868, 5411, 9559, 8095, 9270, 2840, 2478, 4565, 7315, 5078, 10506, 9646, 1095, 9244, 5781, 8195, 8838, 4378, 1241, 9577, 4834, 7937, 9461, 12217, 8176, 1842, 3840, 7014, 10499, 11038,
-#     6879, 2035, 1040, 10407, 6164, 4770, 11345, 7002, 3669, 5673, 3020, 5406, 4665, 3846, 1573, 6063, 3793, 7171, 11787, 1901, 2602, 5969, 7640, 6026, 9360, 1681, 8468, 1030, 466, 1120,
-#     2535, 21, 5808, 791, 9855, 9462, 2873, 2307, 4289, 11641, 12139, 170, 6639, 9988, 11415, 2957, 1481, 9349, 10243, 12150, 8957, 2532, 3317, 8823, 1701, 4697, 8711, 778, 4504, 2626,
-#     11759, 12281, 11832, 4301, 4523, 10440, 6513, 3268, 8494, 3758, 8835, 4218, 4390, 11410, 9696, 982, 10013, 904, 2485, 5547, 5039, 24, 1371, 11675, 11009, 5461, 9343, 2637, 7779, 1015,
-#     10362, 11924, 11408, 10699, 4411, 9955, 11066, 10398, 7186, 10487, 10734, 3418, 7846, 8820, 6138, 417, 9996, 4693, 2338, 1398, 9199, 7246, 11463, 6671, 1658, 6500, 8787, 751, 7570,
-#     6389, 910, 3065, 1506, 6586, 4483, 9667, 6903, 11779, 4661, 5368, 11711, 1944, 450, 8929, 4684, 12226, 7154, 9916, 7302, 8481, 3670, 9348, 11722, 6627, 5289, 3837, 2595, 3221, 4273,
-#     8239, 5207, 11445, 7087, 980, 682, 7699, 5082, 6940, 9344, 10883, 2633, 293, 9057, 3769, 4855, 8809, 10118, 3007, 1265, 6759, 6685, 8345, 8190, 11520, 6763, 216, 50, 8136, 10076, 767,
-#     8484, 7929, 9004, 9135, 7235, 12282, 10353, 11444, 8566, 1706, 8360, 7559, 3229, 10268, 2832, 3572, 1282, 3536, 5370, 3753, 3941, 6184, 9169, 5646, 6086, 10235, 2483, 1344, 3042, 1468,
-#     3981, 3407, 11826, 180, 4138, 7684, 2689, 10880, 7070, 204, 5509, 1057, 9689, 4705, 9168, 9272, 1236, 4475, 5246, 4251, 4739, 11063, 6771, 7073, 9261, 2360, 11925, 11777, 7619, 4906,
-#     6825, 4554, 11295, 239, 2900, 7021, 146, 11883, 10602, 5189, 6094, 1403, 1804, 11667, 10552, 5672, 4499, 636, 5609, 8307, 2947, 3393, 7954, 2291, 3375, 8464, 4235, 8761, 7376, 6492,
-#     8330, 5959, 10141, 7350, 5115, 2442, 1248, 10344, 1029, 5724, 1325, 6691, 8945, 1892, 3624, 10767, 2151, 4119, 3343, 7681, 7126, 7287, 12269, 8342, 338, 9834, 5690, 1744, 1314, 8635,
-#     9395, 4167, 6085, 923, 11251, 6092, 10058, 12096, 2800, 11864, 1836, 11897, 2185, 1620, 375, 7711, 11912, 1942, 3408, 9714, 11124, 9513, 1178, 5478, 8778, 3276, 8951, 2212, 9615, 1392,
-#     5784, 1255, 11783, 1756, 8144, 8328, 8755, 6463, 2065, 7725, 3495, 10771, 8524, 8113, 7226, 2461, 10014, 5653, 8022, 11158, 1445, 7429, 11164, 1275, 6781, 1176, 5734, 12077, 6323, 9520,
-#     3114, 6302, 6693, 579, 3889, 10872, 6613, 4505, 10032, 5835, 9202, 7406, 8314, 5102, 11877, 6701, 6444, 2528, 9233, 4963, 8545, 3607, 10962, 7057, 8347, 11841, 11275, 7365, 7508, 4566,
-#     5836, 12221, 2260, 1535, 3200, 2717, 60, 4238, 11677, 4227, 3368, 11749, 12164, 1526, 4222, 6162, 4840, 8257, 3163, 7885, 346, 2068, 1389, 11197, 5209, 3359, 9084, 11825, 10361, 3678,
-#     4265, 9118, 7800, 10463, 9363, 9051, 8581, 11153, 8840, 5412, 8080, 9011, 6296, 3515, 11851, 1218, 5061, 1536, 1721, 9860, 4103, 10916, 2982, 11572, 3589, 9839, 10584, 11475, 11873,
-#     2110, 716, 5416, 2164, 1866, 5211, 7562, 11081, 10381, 7751, 11946, 3448]
+# Polynomial arithmetic backend, selected at import. NumPy is used when it is installed unless
+# the environment variable NEWHOPE_BACKEND is set to "python".
+if np is not None and os.environ.get("NEWHOPE_BACKEND", "numpy").lower() != "python":
+    BACKEND = "numpy"
+else:
+    BACKEND = "python"
 
-# Generates a randomly distributed polynomial in Rq
-def GenA(publicseed):
+# Returns the polynomial in the representation of the active backend: a uint16 NumPy array
+# for the numpy backend and a list of ints for the python backend
+def AsPoly(a):
+    if BACKEND == "numpy":
+        return np.asarray(a, dtype=np.uint16)
+    return a
+
+# Returns the coefficients of a polynomial (or a batch of polynomials) as Python ints
+def ToList(a):
+    if isinstance(a, array) or (np is not None and isinstance(a, np.ndarray)):
+        return a.tolist()
+    return a
+
+# A NewHope parameter set: the polynomial size n, the modulus q, a primitive nth root of unity
+# mod q for the NTT, and the byte sizes that follow from n. Functions that create polynomials from
+# seeds or messages, or split encoded keys and ciphertexts, take one as params (NewHope1024 by
+# default). Functions given a polynomial work on its length. The NTT tables of a parameter set are
+# loaded on first use. Every NewHope parameter set has q = NEWHOPE_Q and k = NEWHOPE_K, which the
+# sampler, the codecs and their tables are built for, so other values are refused.
+class ParameterSet:
+    __slots__ = ("name", "n", "q", "root", "poly_bytes", "h_bytes", "pk_bytes", "sk_bytes",
+                 "ct_bytes")
+
+    def __init__(self, name, n, q, root):
+        if q != NEWHOPE_Q:
+            raise ValueError("Only q = {} is supported".format(NEWHOPE_Q))
+        self.name = name
+        self.n = n
+        self.q = q
+        self.root = root
+        self.poly_bytes = 7*n//4        # encoded polynomial
+        self.h_bytes = 3*n//8           # compressed polynomial
+        self.pk_bytes = self.poly_bytes + 32
+        self.sk_bytes = self.poly_bytes
+        self.ct_bytes = self.poly_bytes + self.h_bytes
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def tables(self):
+        return GetNTTTables(self.n, self.root, self.q)
+
+    # Pickled by name, so that worker processes use their own instance and tables
+    def __reduce__(self):
+        return (GetParameterSet, (self.name,))
+
+NewHope512 = ParameterSet("NewHope512", 512, NEWHOPE_Q, 3400)      # security level of 101
+NewHope1024 = ParameterSet("NewHope1024", NEWHOPE_N, NEWHOPE_Q, NEWHOPE_ROOT)
+PARAMETER_SETS = {params.name: params for params in (NewHope512, NewHope1024)}
+
+# Returns the parameter set with the given name
+def GetParameterSet(name):
+    return PARAMETER_SETS[name]
+
+# Precomputed tables: the twiddle factors of every parameter set, and the lookup tables of
+# Sample, Compress and Decompress. They are generated from the parameters on first use, then
+# kept in a cache file that later processes memory-map instead of generating them again. The
+# file starts with a header (magic, version, byte order, number of tables, SHA-256 of the
+# directory) and a directory of the tables (name, array type code, offset, size, SHA-256). The
+# directory is checked when the file is opened, and every table against its SHA-256 when it is
+# first read. A missing, outdated or corrupted file is rebuilt. The checksums catch corruption,
+# not tampering: whoever can write the file can rewrite its checksums too. A file that cannot be
+# written (a read-only home directory) is not an error, the tables are then kept in memory only.
+# NEWHOPE_TABLE_CACHE sets the path of the file, and an empty value turns the cache off.
+TABLE_CACHE_MAGIC = b"NHTC"
+TABLE_CACHE_VERSION = 2
+TABLE_CACHE_HEADER = struct.Struct("<4sH1sxI32s")       # magic, version, byte order, count, SHA-256
+TABLE_CACHE_ENTRY = struct.Struct("<48s1s7xQQ32s")      # name, type code, offset, size, SHA-256
+TABLE_CACHE_ORDER = b"<" if sys.byteorder == "little" else b">"
+TABLE_CACHE_TYPECODES = "BH"                            # array type codes of the tables
+
+# Returns the path of the table cache, or None if it is turned off
+def TableCachePath():
+    path = os.environ.get("NEWHOPE_TABLE_CACHE")
+    if path is not None:
+        return path or None
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "newhope", "tables-v{}.bin".format(TABLE_CACHE_VERSION))
+
+# A memory-mapped table cache file opened for reading. A file that cannot be read, or that was
+# written by another version or for another byte order, holds no tables.
+class TableCache:
+    __slots__ = ("path", "mm", "entries")
+
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self.entries = {}
+        try:
+            self.open()
+        except (OSError, ValueError, struct.error) as e:
+            debug("Table cache {} not used: {}".format(path, e))
+            self.close()
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, order, count, directory_digest = TABLE_CACHE_HEADER.unpack_from(self.mm, 0)
+        if magic != TABLE_CACHE_MAGIC:
+            raise ValueError("not a table cache")
+        if version != TABLE_CACHE_VERSION or order != TABLE_CACHE_ORDER:
+            raise ValueError("version {} for byte order {!r}".format(version, order))
+        directory = self.mm[TABLE_CACHE_HEADER.size:TABLE_CACHE_HEADER.size + count*TABLE_CACHE_ENTRY.size]
+        if len(directory) != count*TABLE_CACHE_ENTRY.size:
+            raise ValueError("directory is truncated")
+        if hashlib.sha256(directory).digest() != directory_digest:
+            raise ValueError("directory does not match its checksum")
+        for (name, typecode, offset, size, digest) in TABLE_CACHE_ENTRY.iter_unpack(directory):
+            name = name.rstrip(b"\0").decode()
+            typecode = typecode.decode()
+            if typecode not in TABLE_CACHE_TYPECODES or size % array(typecode).itemsize:
+                raise ValueError("table {} has type code {!r} and size {}".format(name, typecode, size))
+            if offset + size > len(self.mm):
+                raise ValueError("table {} is truncated".format(name))
+            self.entries[name] = (typecode, offset, size, digest)
+
+    # Returns the named table as a read-only memoryview into the file, or None if the file does
+    # not hold it or its checksum does not match
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        typecode, offset, size, digest = entry
+        view = memoryview(self.mm)[offset:offset+size]
+        if hashlib.sha256(view).digest() != digest:
+            warning("Table {} in {} does not match its checksum".format(name, self.path))
+            return None
+        return view.cast(typecode)
+
+    def close(self):
+        self.entries = {}
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:     # tables are still in use, the map is closed when they are freed
+                pass
+
+# Writes the given tables (a dict of arrays by name) as a table cache file. The file is written
+# under a temporary name and renamed, so a process never maps a partly written file.
+def WriteTableCache(path, tables):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    offset = TABLE_CACHE_HEADER.size + len(tables)*TABLE_CACHE_ENTRY.size
+    entries = []
+    blobs = []
+    for (name, table) in sorted(tables.items()):
+        offset += -offset % 8
+        data = table.tobytes()
+        entries.append(TABLE_CACHE_ENTRY.pack(name.encode(), table.typecode.encode(), offset,
+                                              len(data), hashlib.sha256(data).digest()))
+        blobs.append((offset, data))
+        offset += len(data)
+    entries = b"".join(entries)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".tables-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(TABLE_CACHE_HEADER.pack(TABLE_CACHE_MAGIC, TABLE_CACHE_VERSION, TABLE_CACHE_ORDER,
+                                            len(tables), hashlib.sha256(entries).digest()))
+            f.write(entries)
+            for (offset, data) in blobs:
+                f.write(bytes(offset - f.tell()))
+                f.write(data)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+# Names of the tables kept in the cache file
+def StandardTableNames():
+    names = ["sample", "compress", "decompress"]
+    for params in PARAMETER_SETS.values():
+        names.append("psi_rev/{}/{}/{}".format(params.n, params.root, params.q))
+        names.append("psi_inv_rev/{}/{}/{}".format(params.n, params.root, params.q))
+    return names
+
+# Generates the named table. The name is the kind of table followed by its integer parameters,
+# separated by slashes.
+def GenerateTable(name):
+    kind, *args = name.split("/")
+    return TABLE_GENERATORS[kind](*map(int, args))
+
+# Tables by name, and their derived forms by (name, form), for this process
+loaded_tables = {}
+table_cache = None
+
+# Returns the named table as an array or memoryview of ints. A table of the cache file is read
+# from it, and if it is not there every table of the file is generated and the file rewritten.
+# Other tables are generated in memory.
+def GetTable(name):
+    table = loaded_tables.get(name)
+    if table is None:
+        table = loaded_tables[name] = LoadTable(name)
+    return table
+
+def LoadTable(name):
+    global table_cache
+    path = TableCachePath()
+    if path is None or name not in StandardTableNames():
+        return GenerateTable(name)
+    if table_cache is None or table_cache.path != path:
+        table_cache = TableCache(path)
+    table = table_cache.get(name)
+    if table is not None:
+        return table
+    generated = {n: GenerateTable(n) for n in StandardTableNames()}
+    try:
+        WriteTableCache(path, generated)
+        info("Wrote table cache {}".format(path))
+    except OSError as e:
+        debug("Could not write table cache {}: {}".format(path, e))
+    table_cache = None
+    for (n, table) in generated.items():
+        loaded_tables.setdefault(n, table)
+    return generated[name]
+
+# Returns a form of the named table that a function needs (a list of tuples, a NumPy array),
+# converted from it once by convert
+def DerivedTable(name, form, convert):
+    key = (name, form)
+    table = loaded_tables.get(key)
+    if table is None:
+        table = loaded_tables[key] = convert(GetTable(name))
+    return table
 
-    debug("Generating the polynomial a_hat")
-    a_hat = [0]*NEWHOPE_N   # Declare polynomial of size NEWHOPE_N with 0 coefficients
+# Forgets the tables loaded by this process, so that they are read or generated again
+def ResetTables():
+    global table_cache
+    loaded_tables.clear()
+    ntt_tables.clear()
+    table_cache = None
 
-    debug("Initializing extseed")
+# Reads the output of a SHAKE object incrementally. hashlib cannot continue squeezing, it only
+# returns the output from its start, so the reader squeezes several blocks at once and walks
+# through them. When a read runs past them it squeezes again, at least twice as much, so the
+# output is re-digested at most about twice in total however many reads there are.
+class XOFReader:
+    __slots__ = ("state", "buf", "offset")
+
+    def __init__(self, state):
+        self.state = state
+        self.buf = memoryview(b"")
+        self.offset = 0
+
+    # Returns the next nbytes of output
+    def read(self, nbytes):
+        if instruments.enabled:
+            instruments.hashed(nbytes)
+        end = self.offset + nbytes
+        if end > len(self.buf):
+            self.buf = memoryview(self.state.digest(max(end, 2*len(self.buf))))
+        buf = self.buf[self.offset:end]
+        self.offset = end
+        return buf
+
+# Parses a block of SHAKE-128 output as little-endian 16-bit values
+SQUEEZE_BLOCK_U16 = struct.Struct("<{}H".format(SQUEEZE_BLOCK_SIZE//2))
+
+# Returns the 64 coefficients of a_hat generated from extseed = publicseed || i. The SHAKE-128
+# output is squeezed one block at a time until 64 values below 5q have been accepted.
+def GenABlock(extseed):
+    xof = XOFReader(hashlib.shake_128(extseed))
+    block = []
+    while len(block) < 64:
+        buf = xof.read(SQUEEZE_BLOCK_SIZE)
+        block += [val % NEWHOPE_Q for val in SQUEEZE_BLOCK_U16.unpack(buf) if val < (5*NEWHOPE_Q)]
+    return block[0:64]
+
+# Generates a randomly distributed polynomial in Rq
+def GenA(publicseed, params=NewHope1024):
+    a_hat = [0]*params.n   # Declare polynomial of size n with 0 coefficients
     extseed = bytearray(33)
     extseed[0:32] = publicseed[0:32]
-
-    debug("Starting loop")
-    for i in range(0, (NEWHOPE_N//64)):
-        ctr = 0
+    for i in range(0, (params.n//64)):
         extseed[32] = i
-        state = hashlib.shake_128(extseed)
-        while ctr < 64:
-            buf = state.digest(SQUEEZE_BLOCK_SIZE*1)
-            j = 0
-            while (j<168) and (ctr<64):     # The algorithm has this in a for-loop, but this while loop is equivalent
-                buf0 = int(buf[j])
-                buf1 = (int(buf[j+1]) << 8) % 4294967296      # 2^32 = 4294967296
-                val = buf0|buf1
-                if val<(5*NEWHOPE_Q):
-                    a_hat[(64*i)+ctr] = val % NEWHOPE_Q
-                    ctr += 1
-                j += 2
-
-    debug("Done generating a_hat")
-    return a_hat
-
-# Samples the R-LWE secret and error
-def Sample(noiseseed, nonce):
+        a_hat[(64*i):(64*i)+64] = GenABlock(extseed)
+    return AsPoly(a_hat)
 
-    debug("Sampling a random polynomial in Rq")
-    r = [0]*NEWHOPE_N   # Declare polynomial of size NEWHOPE_N
+# Number of set bits of every byte value
+POPCOUNT = [bin(i).count("1") for i in range(256)]
 
-    debug("Initializing extseed and setting nonce ")
+# Returns the "sample" table: the noise coefficient for every pair of bytes (a, b) read as the
+# little-endian 16-bit value a | b<<8, the centered binomial sample popcount(a) - popcount(b) mod q
+def SampleTable():
+    return array("H", [(POPCOUNT[v & 0xff] + NEWHOPE_Q - POPCOUNT[v >> 8]) % NEWHOPE_Q
+                       for v in range(1 << 16)])
+
+# Returns the SHAKE-256 output for all n/64 blocks of noise in one buffer
+def SampleBuffer(noiseseed, nonce, params=NewHope1024):
     extseed = bytearray(34)
     extseed[0:32] = noiseseed[0:32]
     extseed[32] = nonce
-
-    debug("Starting loop")
-    for i in range(0, (NEWHOPE_N//64)):     # Generate noise in lbocks of 64 coefficients
+    buf = bytearray(2*params.n)
+    if instruments.enabled:
+        instruments.hashed(len(buf))
+    for i in range(0, (params.n//64)):     # Generate noise in blocks of 64 coefficients
         extseed[33] = i
-        buf = hashlib.shake_256(extseed).digest(128)
-        for j in range(0, 64):
-            a = buf[2*j]
-            b = buf[(2*j)+1]
-            r[(64*i)+j] = (bin(a).count("1") + NEWHOPE_Q - bin(b).count("1")) % NEWHOPE_Q
+        buf[(128*i):(128*i)+128] = hashlib.shake_256(extseed).digest(128)
+    return buf
 
-    debug("Done sampling random polynomial in Rq")
-    return r
+# Samples the R-LWE secret and error. Every coefficient is looked up in the sample table from the
+# pair of bytes it is sampled from.
+def Sample(noiseseed, nonce, params=NewHope1024):
+    buf = SampleBuffer(noiseseed, nonce, params)
+
+    if BACKEND == "numpy":
+        return SampleTableArray()[np.frombuffer(buf, dtype="<u2")]
+
+    pairs = array("H", buf)
+    if sys.byteorder == "big":
+        pairs.byteswap()
+    table = GetTable("sample")
+    return array("H", [table[v] for v in pairs])
 
 # Multiplies two polynomials coefficient-wise
 def Poly_mul(a, b):
-    c = [0]*NEWHOPE_N
-    for i in range(0, NEWHOPE_N):
+    c = [0]*len(a)
+    for i in range(0, len(a)):
         c[i] = (a[i]*b[i]) % NEWHOPE_Q
     return c
 
 # Adds two polynomials coefficient-wise
 def Poly_add(a, b):
-    c = [0]*NEWHOPE_N
-    for i in range(0, NEWHOPE_N):
+    c = [0]*len(a)
+    for i in range(0, len(a)):
         c[i] = (a[i]+b[i]) % NEWHOPE_Q
     return c
 
 # Subtracts two polynomials coefficient-wise
 def PolySubtract(a, b):
-    c = [0]*NEWHOPE_N
-    for i in range(0, NEWHOPE_N):
+    c = [0]*len(a)
+    for i in range(0, len(a)):
         c[i] = (a[i]-b[i]) % NEWHOPE_Q
     return c
 
-# # Implementation from Patrick Longa and Michael Naehrig
-# # - Algorithm 1: NTT
-# # Title: "Speeding up the Number Theoretic Transform for Faster Ideal Lattice-Based Cryptography"
-# # URL: "https://eprint.iacr.org/2016/504.pdf"
-# def NTT(a):
-#
-#     debug("Starting NTT")
-#     t = NEWHOPE_N
-#     m = 1
-#
-#     debug("Beginning while-loop in NTT")
-#     while(m < NEWHOPE_N):
-#         t = t//2
-#         for i in range(0, m):
-#             j1 = 2*i*t
-#             j2 = j1 + t - 1
-#             s = psi_bitrev[m+i]
-#             for j in range(j1, j2+1):
-#                 u = a[j]
-#                 v = a[j+t]*s
-#                 a[j] = (u+v) % NEWHOPE_Q
-#                 a[j+t] = (u-v) % NEWHOPE_Q
-#         m = 2*m
-#     debug("End of while-loop in NTT")
-#     return a
-#
-# # Implementation from Patrick Longa and Michael Naehrig
-# # - Algorithm 2: INTT
-# # Title: "Speeding up the Number Theoretic Transform for Faster Ideal Lattice-Based Cryptography"
-# # URL: "https://eprint.iacr.org/2016/504.pdf"
-# def INTT(a):
-#     t = 1
-#     m = NEWHOPE_N
-#     while (m > 1):
-#         j1 = 0
-#         h = m//2
-#         for i in range(0, h):
-#             j2 = j1 + t - 1
-#             s = psi_bitrev_inv[h+1]
-#             for j in range(j1, j2+1):
-#                 u = a[j]
-#                 v = a[j+1]
-#                 a[j] = (u+v) % NEWHOPE_Q
-#                 a[j+t] = (u-v)*s % NEWHOPE_Q
-#             j1 = j1 + (2*t)
-#         t = 2*t
-#         m = m//2
-#     for j in range(0, NEWHOPE_N):
-#         a[j] = (a[j]*NEWHOPE_N_INV) % NEWHOPE_Q
-#     return a
-
 # Returns the forward number-theoretic transform of the given vector with
 # respect to the given primitive nth root of unity under the given modulus.
-def NTT(invec, root, mod):
+# This is the textbook O(n^2) transform, kept as a reference for NTT/INTT.
+def NTT_naive(invec, root, mod):
 	outvec = []
 	for i in range(len(invec)):
 		temp = 0
@@ -239,8 +419,8 @@ def NTT(invec, root, mod):
 
 # Returns the inverse number-theoretic transform of the given vector with
 # respect to the given primitive nth root of unity under the given modulus.
-def INTT(invec, root, mod):
-	outvec = NTT(invec, reciprocal(root, mod), mod)
+def INTT_naive(invec, root, mod):
+	outvec = NTT_naive(invec, reciprocal(root, mod), mod)
 	scaler = reciprocal(len(invec), mod)
 	return [(val * scaler % mod) for val in outvec]
 
@@ -259,122 +439,320 @@ def reciprocal(n, mod):
 	else:
 		raise ValueError("Reciprocal does not exist")
 
+# Samples the R-LWE secret and error one coefficient at a time with bin().count. This is the
+# original sampler, kept as a reference for Sample.
+def Sample_naive(noiseseed, nonce):
+
+    debug("Sampling a random polynomial in Rq")
+    r = [0]*NEWHOPE_N   # Declare polynomial of size NEWHOPE_N
+
+    debug("Initializing extseed and setting nonce ")
+    extseed = bytearray(34)
+    extseed[0:32] = noiseseed[0:32]
+    extseed[32] = nonce
+
+    debug("Starting loop")
+    for i in range(0, (NEWHOPE_N//64)):     # Generate noise in blocks of 64 coefficients
+        extseed[33] = i
+        buf = hashlib.shake_256(extseed).digest(128)
+        for j in range(0, 64):
+            a = buf[2*j]
+            b = buf[(2*j)+1]
+            r[(64*i)+j] = (bin(a).count("1") + NEWHOPE_Q - bin(b).count("1")) % NEWHOPE_Q
+
+    debug("Done sampling random polynomial in Rq")
+    return r
+
+# Returns the bit-reversal of i as a number of the given bit width
+def bitrev(i, bits):
+    r = 0
+    for _ in range(bits):
+        r = (r << 1) | (i & 1)
+        i >>= 1
+    return r
+
+# Returns the "psi_rev" table for polynomials of length n, where root is a primitive nth root of
+# unity mod mod. psi is a square root of root (a primitive 2nth root of unity), so that the
+# negacyclic scaling by powers of psi can be folded into the butterflies. psi_rev[k] = psi^bitrev(k)
+# as in Longa and Naehrig, or psi^-bitrev(k) for the "psi_inv_rev" table of the inverse.
+def PsiRevTable(n, root, mod, inverse=False):
+    psi = next(x for x in range(2, mod) if x*x % mod == root)
+    if inverse:
+        psi = reciprocal(psi, mod)
+    bits = n.bit_length() - 1
+    return array("H", [pow(psi, bitrev(k, bits), mod) for k in range(0, n)])
+
+# Builds the twiddle tables used by NTT and INTT from the psi_rev and psi_inv_rev tables.
+# psi_rev[n/2] = psi^bitrev(n/2) = psi.
+def NTTTables(n, root, mod):
+    psi_rev = GetTable("psi_rev/{}/{}/{}".format(n, root, mod))
+    psi_inv_rev = GetTable("psi_inv_rev/{}/{}/{}".format(n, root, mod))
+    tables = {"n": n, "root": root, "mod": mod, "psi": psi_rev[n//2], "n_inv": reciprocal(n, mod),
+            "psi_rev": psi_rev, "psi_inv_rev": psi_inv_rev}
+    if np is not None:
+        tables["psi_rev_np"] = np.frombuffer(psi_rev, dtype=np.uint16).astype(np.int32)
+        tables["psi_inv_rev_np"] = np.frombuffer(psi_inv_rev, dtype=np.uint16).astype(np.int32)
+    return tables
+
+# Twiddle tables keyed by (n, root, mod), built on first use
+ntt_tables = {}
+
+def GetNTTTables(n, root, mod):
+    key = (n, root, mod)
+    tables = ntt_tables.get(key)
+    if tables is None:
+        tables = ntt_tables[key] = NTTTables(n, root, mod)
+    return tables
+
+# Implementation from Patrick Longa and Michael Naehrig
+# - Algorithm 1: NTT (Cooley-Tukey butterflies, natural order in, bit-reversed order out)
+# Title: "Speeding up the Number Theoretic Transform for Faster Ideal Lattice-Based Cryptography"
+# URL: "https://eprint.iacr.org/2016/504.pdf"
+# Returns the negacyclic transform: output[bitrev(i)] = sum_j invec[j] * psi^((2i+1)j), so that
+# pointwise products in the NTT domain are products in Z_q[x]/(x^n + 1).
+def NTT(invec, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    n = len(invec)
+    psi_rev = GetNTTTables(n, root, mod)["psi_rev"]
+    a = [x % mod for x in invec]
+    t = n
+    m = 1
+    while m < n:
+        t = t//2
+        for i in range(0, m):
+            j1 = 2*i*t
+            s = psi_rev[m+i]
+            for j in range(j1, j1+t):
+                u = a[j]
+                v = a[j+t]*s % mod
+                a[j] = (u+v) % mod
+                a[j+t] = (u-v) % mod
+        m = 2*m
+    return a
+
+# Implementation from Patrick Longa and Michael Naehrig
+# - Algorithm 2: INTT (Gentleman-Sande butterflies, bit-reversed order in, natural order out)
+# Title: "Speeding up the Number Theoretic Transform for Faster Ideal Lattice-Based Cryptography"
+# URL: "https://eprint.iacr.org/2016/504.pdf"
+# The final scaling by n^-1 is folded into the last butterfly stage.
+def INTT(invec, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    n = len(invec)
+    tables = GetNTTTables(n, root, mod)
+    psi_inv_rev = tables["psi_inv_rev"]
+    n_inv = tables["n_inv"]
+    a = list(invec)
+    t = 1
+    m = n
+    while m > 2:
+        j1 = 0
+        h = m//2
+        for i in range(0, h):
+            s = psi_inv_rev[h+i]
+            for j in range(j1, j1+t):
+                u = a[j]
+                v = a[j+t]
+                a[j] = (u+v) % mod
+                a[j+t] = (u-v)*s % mod
+            j1 = j1 + (2*t)
+        t = 2*t
+        m = m//2
+    s = psi_inv_rev[1]*n_inv % mod
+    for j in range(0, t):
+        u = a[j]
+        v = a[j+t]
+        a[j] = (u+v)*n_inv % mod
+        a[j+t] = (u-v)*s % mod
+    return a
+
+# Fused NTT-domain kernels for PKEGen, Encrypt and Decrypt. Each replaces a chain of Poly_mul,
+# Poly_add, INTT, Compress or DecodeMsg calls with one pass that reduces modulo q only where the
+# bounds need it, and gives exactly the same result as the chain.
+
+# Returns a*b + c coefficient-wise, with one reduction instead of two
+def PolyMulAdd(a, b, c, mod=NEWHOPE_Q):
+    return [(x*y + z) % mod for (x, y, z) in zip(a, b, c)]
+
+# Runs every INTT stage but the last on the pointwise product a*b. The sums are left unreduced
+# (after the 9 stages they are below 2^9 q) and only the differences, which are multiplied by a
+# twiddle factor, are reduced.
+def INTTStagesLazy(a, b, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    w = [x*y % mod for (x, y) in zip(a, b)]
+    n = len(w)
+    psi_inv_rev = GetNTTTables(n, root, mod)["psi_inv_rev"]
+    t = 1
+    m = n
+    while m > 2:
+        j1 = 0
+        h = m//2
+        for i in range(0, h):
+            s = psi_inv_rev[h+i]
+            for j in range(j1, j1+t):
+                u = w[j]
+                v = w[j+t]
+                w[j] = u+v
+                w[j+t] = (u-v)*s % mod
+            j1 = j1 + (2*t)
+        t = 2*t
+        m = m//2
+    return w
+
+# Returns Compress(INTT(a*b) + e + v). The last INTT stage, the additions and the compression
+# run in one pass over groups of 8 coefficients, written straight into the compressed bytes.
+def INTTAddCompress(a, b, e, v, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    w = INTTStagesLazy(a, b, root, mod)
+    n = len(w)
+    half = n//2
+    tables = GetNTTTables(n, root, mod)
+    n_inv = tables["n_inv"]
+    s = tables["psi_inv_rev"][1]*n_inv % mod
+    h = bytearray(3*n//8)
+    for j in range(0, half, 8):
+        lo = 0
+        hi = 0
+        for k in range(0, 8):
+            u = w[j+k]
+            x = w[j+k+half]
+            lo |= (((((u+x)*n_inv + e[j+k] + v[j+k]) % mod << 3) + mod//2)//mod & 7) << (3*k)
+            hi |= (((((u-x)*s + e[j+k+half] + v[j+k+half]) % mod << 3) + mod//2)//mod & 7) << (3*k)
+        h[3*j//8:3*j//8+3] = lo.to_bytes(3, "little")
+        h[3*(j+half)//8:3*(j+half)//8+3] = hi.to_bytes(3, "little")
+    return bytes(h)
+
+# Returns DecodeMsg(v - INTT(a*b)). The last INTT stage, the subtraction and the decoding run in
+# one pass: message bit i is read from the n/256 coefficients i + 256j, which the last stage
+# computes from the ones below n/2 and their partners n/2 apart.
+def INTTSubtractDecode(a, b, v, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    w = INTTStagesLazy(a, b, root, mod)
+    n = len(w)
+    half = n//2
+    tables = GetNTTTables(n, root, mod)
+    n_inv = tables["n_inv"]
+    s = tables["psi_inv_rev"][1]*n_inv % mod
+    threshold = (n//256)*mod//4
+    m = [0]*32
+    for i in range(0, 256):
+        t = 0
+        for j in range(i, half, 256):
+            u = w[j]
+            x = w[j+half]
+            t += abs((v[j] - (u+x)*n_inv) % mod - mod//2)
+            t += abs((v[j+half] - (u-x)*s) % mod - mod//2)
+        if t < threshold:
+            m[i>>3] |= 1 << (i&7)
+    return m
+
+# Returns a read-only byte view of an encoded key, ciphertext or polynomial. Any buffer-protocol
+# object (bytes, bytearray, memoryview, mmap, uint8 array) is viewed without copying, a list of
+# byte values is converted.
+def AsBuffer(v):
+    if isinstance(v, (list, tuple)):
+        return memoryview(bytes(v))
+    return memoryview(v).cast("B")
+
 # Encodes the ciphertext and error
 def EncodeC(u, h):
-    c = [0]*(NEWHOPE_7N_4 + NEWHOPE_3N_8)
-    c[0:NEWHOPE_7N_4] = EncodePoly(u)
-    c[NEWHOPE_7N_4:] = h
-    return c
+    return EncodePoly(u) + bytes(h)
 
-# Encodes a polynomial in Rq as an array of bytes
+# Encodes a polynomial in Rq as bytes. The coefficients are written as a little-endian stream of
+# 14-bit values, so every 4 coefficients are packed into one 56-bit integer and written as 7 bytes.
 def EncodePoly(s):
-    r = [0]*NEWHOPE_7N_4
-    for i in range(0, 256):
-        t0 = s[(4*i)+0] % NEWHOPE_Q
-        t1 = s[(4*i)+1] % NEWHOPE_Q
-        t2 = s[(4*i)+2] % NEWHOPE_Q
-        t3 = s[(4*i)+3] % NEWHOPE_Q
-        r[(7*i)+0] = t0 & int(0xff)
-        r[(7*i)+1] = (t0 >> 8) | ((t1 << 6)%4294967296) & int(0xff)
-        r[(7*i)+2] = (t1 >> 2) & int(0xff)
-        r[(7*i)+3] = (t1 >> 10) | ((t2 << 4)%4294967296) & int(0xff)
-        r[(7*i)+4] = (t2 >> 4) & int(0xff)
-        r[(7*i)+5] = (t2 >> 12) | ((t3 << 2)%4294967296) & int(0xff)
-        r[(7*i)+6] = (t3 >> 6) & int(0xff)
-    return r
+    s = [x % NEWHOPE_Q for x in ToList(s)]
+    return b"".join([(s[i] | (s[i+1] << 14) | (s[i+2] << 28) | (s[i+3] << 42)).to_bytes(7, "little")
+                     for i in range(0, len(s), 4)])
 
 # Encodes the public key
 def EncodePK(b_hat, publicseed):
-    r = [0]*(NEWHOPE_7N_4 + 32)
-    r[0:NEWHOPE_7N_4] = EncodePoly(b_hat)
-    r[NEWHOPE_7N_4:] = publicseed
-    return r
+    return EncodePoly(b_hat) + bytes(publicseed)
 
-# Encodes the 32-byte message to a polynomial in Rq
-def EncodeMsg(m):
-    v = [0]*NEWHOPE_N
+# Encodes the 32-byte message to a polynomial in Rq. Every bit is written to the n/256
+# coefficients 256 apart.
+def EncodeMsg(m, params=NewHope1024):
+    v = [0]*params.n
     for i in range(0, 32):
         for j in range(0, 8):
             mask = -(((m[i]>>j))&1)
-            v[(8*i)+j+0] = (mask&(NEWHOPE_Q//2)) #% NEWHOPE_Q
-            v[(8*i)+j+256] = (mask&(NEWHOPE_Q//2)) #% NEWHOPE_Q
-            v[(8*i)+j+512] = (mask&(NEWHOPE_Q//2)) #% NEWHOPE_Q
-            v[(8*i)+j+768] = (mask&(NEWHOPE_Q//2)) #% NEWHOPE_Q
+            for k in range(0, params.n, 256):
+                v[(8*i)+j+k] = (mask&(NEWHOPE_Q//2)) #% NEWHOPE_Q
     return v
 
-# Decodes the ciphertext and error
-def DecodeC(c):
-    u = DecodePoly(c[0:NEWHOPE_7N_4])
-    h = c[NEWHOPE_7N_4:]
+# Decodes the ciphertext and error. h is a view into c.
+def DecodeC(c, params=NewHope1024):
+    c = AsBuffer(c)
+    u = DecodePoly(c[0:params.poly_bytes])
+    h = c[params.poly_bytes:]
     return u, h
 
-# Decodes an array of bytes to a polynomial in Rq
+# Decodes bytes to a polynomial in Rq, reading every 7 bytes as one 56-bit integer holding
+# 4 coefficients of 14 bits
 def DecodePoly(v):
-    debug('Starting decoding polynomial')
-    r = [0]*NEWHOPE_N
-    for i in range(0, 256):
-        r[(4*i)+0] = int(v[(7*i)+0]) | (((int(v[(7*i)+1])&int(0x3f))<<8)%4294967296)
-        r[(4*i)+1] = (int(v[(7*i)+1]) >> 6) | ((int(v[(7*i)+2]) << 2)%4294967296) | (((int(v[(7*i)+3])&int(0x0f))<<10)%4294967296)
-        r[(4*i)+2] = (int(v[(7*i)+3]) >> 4) | ((int(v[(7*i)+4]) << 4)%4294967296) | (((int(v[(7*i)+5])&int(0x03))<<12)%4294967296)
-        r[(4*i)+3] = (int(v[(7*i)+5]) >> 2) | ((int(v[(7*i)+6]) << 6)%4294967296)
-    debug('Done decoding polynomial')
-    return r
+    v = AsBuffer(v)
+    r = [0]*(4*(len(v)//7))
+    for i in range(0, len(v)//7):
+        x = int.from_bytes(v[(7*i):(7*i)+7], "little")
+        r[(4*i)+0] = x & 0x3fff
+        r[(4*i)+1] = (x >> 14) & 0x3fff
+        r[(4*i)+2] = (x >> 28) & 0x3fff
+        r[(4*i)+3] = x >> 42
+    return AsPoly(r)
 
-# Encodes the 32-byte message to a polynomial in Rq
+# Decodes the polynomial to the 32-byte message. Bit i is set when its n/256 coefficients are
+# closer to q/2 than to 0 in total.
 def DecodeMsg(v):
+    copies = len(v)//256
     m = [0]*32
     for i in range(0, 256):
-        t = abs(((v[i+0])%NEWHOPE_Q) - ((NEWHOPE_Q)//2))
-        t = t + abs((((v[i+256])%NEWHOPE_Q) - ((NEWHOPE_Q)//2)))
-        t = t + abs((((v[i+512])%NEWHOPE_Q) - ((NEWHOPE_Q)//2)))
-        t = t + abs((((v[i+768])%NEWHOPE_Q) - ((NEWHOPE_Q)//2)))
-        t = t - NEWHOPE_Q
+        t = 0
+        for k in range(0, 256*copies, 256):
+            t = t + abs((((v[i+k])%NEWHOPE_Q) - ((NEWHOPE_Q)//2)))
+        t = t - copies*NEWHOPE_Q//4
         t = t >> 15
         m[i>>3] = m[i>>3] | -(t<<(i&7))
     return m
 
-# Decodes the public key
-def DecodePK(pk):
-    debug('Starting decoding public key')
-    b_hat = DecodePoly(pk[0:NEWHOPE_7N_4])
-    seed = pk[NEWHOPE_7N_4:]
-    debug('Done decoding public key')
+# Decodes the public key. The returned seed is a view into pk.
+def DecodePK(pk, params=NewHope1024):
+    pk = AsBuffer(pk)
+    b_hat = DecodePoly(pk[0:params.poly_bytes])
+    seed = pk[params.poly_bytes:]
     return b_hat, seed
 
-# Compresses a message to send
-def Compress(v):
+# Compresses a message to send, one group of 8 coefficients at a time. This is the original
+# scalar Compress, kept as a reference for Compress.
+def Compress_naive(v):
+    v = ToList(v)
     k = 0
     t = [0]*8
-    h = [0]*NEWHOPE_3N_8
-    for l in range(0, 128):
+    h = [0]*(3*len(v)//8)
+    for l in range(0, len(v)//8):
         i = 8*l
         for j in range(0, 8):
             t[j] = v[i+j] % NEWHOPE_Q
             t[j] = (((int(t[j]<<3))+NEWHOPE_Q//2)//NEWHOPE_Q) & int(0x7)
-        h[k+0] = (t[0] | ((t[1]<<3)) | ((t[2]<<6))) #%256
-        h[k+1] = ((t[2]>>2) | ((t[3]<<1)) | ((t[4]<<4)) | ((t[5]<<7))) #%256
-        h[k+2] = ((t[5]>>1) | ((t[6]<<2)) | ((t[7]<<5))) #%256
+        h[k+0] = (t[0] | ((t[1]<<3)) | ((t[2]<<6))) & 0xff
+        h[k+1] = ((t[2]>>2) | ((t[3]<<1)) | ((t[4]<<4)) | ((t[5]<<7))) & 0xff
+        h[k+2] = ((t[5]>>1) | ((t[6]<<2)) | ((t[7]<<5))) & 0xff
         # print("============================compress================================")
         # print(h)
         # print("============================compress================================")
         k += 3
-    return h
+    return bytes(h)
 
-# Decompresses the message to recover the data
-def Decompress(h):
-    r = [0]*NEWHOPE_N
+# Decompresses the message to recover the data. This is the original scalar Decompress, kept as a
+# reference for Decompress.
+def Decompress_naive(h):
+    h = AsBuffer(h)
+    r = [0]*(8*len(h)//3)
     k = 0
     # print("============================input================================")
     # print(h)
     # print("============================input================================")
-    for l in range(0, 128):
+    for l in range(0, len(h)//3):
         i = 8*l
         r[i+0] = h[k+0] & 7
         r[i+1] = (h[k+0]>>3) & 7
-        r[i+2] = (h[k+0]>>6) | (((h[1]<<2))&4)
+        r[i+2] = (h[k+0]>>6) | (((h[k+1]<<2))&4)
         r[i+3] = (h[k+1]>>1) & 7
         r[i+4] = (h[k+1]>>4) & 7
-        r[i+5] = (h[k+1]>>7) | (((h[2]<<1))&6)
+        r[i+5] = (h[k+1]>>7) | (((h[k+2]<<1))&6)
         r[i+6] = (h[k+2]>>2) & 7
         r[i+7] = (h[k+2]>>5)
         k += 3
@@ -383,90 +761,2824 @@ def Decompress(h):
         # print("============================decompress================================")
         for j in range(0, 8):
             r[i+j] = (((r[i+j])*NEWHOPE_Q)+4)>>3
-    return r
+    return AsPoly(r)
 
-# Generates the public and private key
-def PKEGen():
+# Returns the "compress" table: the 3-bit value ((x<<3) + q/2)/q of every coefficient x in [0, q)
+def CompressTable():
+    return array("B", [(((x<<3) + NEWHOPE_Q//2)//NEWHOPE_Q) & 7 for x in range(NEWHOPE_Q)])
 
-    debug("Generating the 32-byte random seed")
-    seed = os.urandom(32)
+# Returns the "decompress" table: the decompressed coefficients ((r*q) + 4)>>3 of the four 3-bit
+# values r in every 12-bit string, 4 entries per string
+def DecompressTable():
+    return array("H", [(((x >> (3*j)) & 7)*NEWHOPE_Q + 4) >> 3
+                       for x in range(1 << 12) for j in range(0, 4)])
+
+# The decompress table as one tuple of 4 coefficients per 12-bit string
+def DecompressTuples():
+    return DerivedTable("decompress", "tuples", lambda table: list(zip(*[iter(table)]*4)))
+
+# Compresses a polynomial to 3 bits per coefficient. The 3-bit h is a little-endian bitstream, so
+# each group of 8 values is one 24-bit integer written as 3 bytes.
+def Compress(v):
+    table = GetTable("compress")
+    t = [table[x % NEWHOPE_Q] for x in ToList(v)]
+    return b"".join((t[i] | t[i+1]<<3 | t[i+2]<<6 | t[i+3]<<9 | t[i+4]<<12 | t[i+5]<<15
+                     | t[i+6]<<18 | t[i+7]<<21).to_bytes(3, "little") for i in range(0, len(t), 8))
+
+# Decompresses h, looking up the coefficients of each 12 bits (4 values) in the decompress table
+def Decompress(h):
+    h = AsBuffer(h)
+    table = DecompressTuples()
+    r = []
+    for k in range(0, len(h), 3):
+        x = h[k] | (h[k+1] << 8) | (h[k+2] << 16)
+        r += table[x & 0xfff]
+        r += table[x >> 12]
+    return AsPoly(r)
+
+# Generators of the precomputed tables, by kind (see GenerateTable)
+TABLE_GENERATORS = {"sample": SampleTable,
+                    "compress": CompressTable,
+                    "decompress": DecompressTable,
+                    "psi_rev": lambda n, root, mod: PsiRevTable(n, root, mod),
+                    "psi_inv_rev": lambda n, root, mod: PsiRevTable(n, root, mod, inverse=True)}
+
+# NumPy backend. Polynomials are uint16 arrays and the coefficient arithmetic runs on whole arrays
+# in int32 (products of two coefficients are below q^2 < 2^31). All functions act on the last
+# axis, so they also accept a stack of polynomials.
+
+# Multiplies two polynomials coefficient-wise
+def Poly_mul_numpy(a, b):
+    c = np.asarray(a, dtype=np.int32) * np.asarray(b, dtype=np.int32)
+    return (c % NEWHOPE_Q).astype(np.uint16)
+
+# Adds two polynomials coefficient-wise
+def Poly_add_numpy(a, b):
+    c = np.asarray(a, dtype=np.int32) + np.asarray(b, dtype=np.int32)
+    return (c % NEWHOPE_Q).astype(np.uint16)
+
+# Subtracts two polynomials coefficient-wise
+def PolySubtract_numpy(a, b):
+    c = np.asarray(a, dtype=np.int32) - np.asarray(b, dtype=np.int32)
+    return (c % NEWHOPE_Q).astype(np.uint16)
+
+# Array version of NTT: each stage of butterflies is one operation over the whole array
+def NTT_numpy(invec, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    a = np.asarray(invec, dtype=np.int32) % mod
+    lead, n = a.shape[:-1], a.shape[-1]
+    psi_rev = GetNTTTables(n, root, mod)["psi_rev_np"]
+    t = n
+    m = 1
+    while m < n:
+        t = t//2
+        a = a.reshape(lead + (m, 2, t))
+        u = a[..., 0, :]
+        v = a[..., 1, :]*psi_rev[m:2*m, None] % mod
+        a = np.stack(((u+v) % mod, (u-v) % mod), axis=-2)
+        m = 2*m
+    return a.reshape(lead + (n,)).astype(np.uint16)
+
+# Array version of INTT, with the scaling by n^-1 folded into the last stage
+def INTT_numpy(invec, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    a = np.asarray(invec, dtype=np.int32)
+    lead, n = a.shape[:-1], a.shape[-1]
+    tables = GetNTTTables(n, root, mod)
+    psi_inv_rev = tables["psi_inv_rev_np"]
+    n_inv = tables["n_inv"]
+    t = 1
+    m = n
+    while m > 2:
+        h = m//2
+        a = a.reshape(lead + (h, 2, t))
+        u = a[..., 0, :]
+        v = a[..., 1, :]
+        a = np.stack(((u+v) % mod, (u-v)*psi_inv_rev[h:m, None] % mod), axis=-2)
+        t = 2*t
+        m = h
+    a = a.reshape(lead + (2, t))
+    u = a[..., 0, :]
+    v = a[..., 1, :]
+    s = int(psi_inv_rev[1])*n_inv % mod
+    a = np.stack(((u+v)*n_inv % mod, (u-v)*s % mod), axis=-2)
+    return a.reshape(lead + (n,)).astype(np.uint16)
+
+# Array version of EncodePoly
+def EncodePoly_numpy(s):
+    return EncodePolyBatch(s).tobytes()
+
+# Array version of DecodePoly, reading the encoded polynomial in place
+def DecodePoly_numpy(v):
+    return DecodePolyBatch(np.frombuffer(AsBuffer(v), dtype=np.uint8))[0]
+
+# Array version of EncodeMsg: every message bit is written to its n/256 replicas at once
+def EncodeMsg_numpy(m, params=NewHope1024):
+    bits = np.unpackbits(np.frombuffer(bytes(m), dtype=np.uint8), bitorder="little")
+    return np.tile(bits.astype(np.uint16)*(NEWHOPE_Q//2), params.n//256)
+
+# Array version of DecodeMsg
+def DecodeMsg_numpy(v):
+    t = np.abs(np.asarray(v, dtype=np.int32) % NEWHOPE_Q - NEWHOPE_Q//2)
+    copies = t.shape[-1]//256
+    t = t.reshape(copies, 256).sum(axis=0) - copies*NEWHOPE_Q//4
+    return np.packbits(t < 0, bitorder="little").tolist()
+
+# Array version of PolyMulAdd. a*b + c is below q^2 + 2^16, so it is computed in int32.
+def PolyMulAdd_numpy(a, b, c, mod=NEWHOPE_Q):
+    w = np.multiply(a, b, dtype=np.int32)
+    w += c
+    w %= mod
+    return w.astype(np.uint16)
+
+# Array version of INTTStagesLazy, working in place in one int64 buffer with one scratch buffer.
+# The unreduced sums stay below 2^9 q, so the differences times a twiddle factor fit in int64.
+def INTTStagesLazy_numpy(a, b, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    w = np.multiply(a, b, dtype=np.int64)
+    w %= mod
+    lead, n = w.shape[:-1], w.shape[-1]
+    psi_inv_rev = GetNTTTables(n, root, mod)["psi_inv_rev_np"]
+    d = np.empty(lead + (n//2,), dtype=np.int64)
+    t = 1
+    m = n
+    while m > 2:
+        h = m//2
+        w = w.reshape(lead + (h, 2, t))
+        u = w[..., 0, :]
+        v = w[..., 1, :]
+        dd = d.reshape(lead + (h, t))
+        np.subtract(u, v, out=dd)
+        u += v
+        dd *= psi_inv_rev[h:m, None]
+        np.remainder(dd, mod, out=v)
+        t = 2*t
+        m = h
+    return w.reshape(lead + (2, n//2)), d
+
+# Array version of INTTAddCompress, returning an (..., 3n/8) uint8 array
+def INTTAddCompress_numpy(a, b, e, v, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    w, d = INTTStagesLazy_numpy(a, b, root, mod)
+    n = 2*w.shape[-1]
+    tables = GetNTTTables(n, root, mod)
+    n_inv = tables["n_inv"]
+    u = w[..., 0, :]
+    x = w[..., 1, :]
+    np.subtract(u, x, out=d)
+    u += x
+    u *= n_inv
+    np.multiply(d, int(tables["psi_inv_rev"][1])*n_inv % mod, out=x)
+    w = w.reshape(w.shape[:-2] + (n,))
+    w += e
+    w += v
+    w %= mod
+    w <<= 3
+    w += mod//2
+    w //= mod
+    w &= 7
+    return Pack3_numpy(w)
+
+# Array version of INTTSubtractDecode, returning an (..., 32) uint8 array
+def INTTSubtractDecode_numpy(a, b, v, root=NEWHOPE_ROOT, mod=NEWHOPE_Q):
+    w, d = INTTStagesLazy_numpy(a, b, root, mod)
+    n = 2*w.shape[-1]
+    tables = GetNTTTables(n, root, mod)
+    n_inv = tables["n_inv"]
+    u = w[..., 0, :]
+    x = w[..., 1, :]
+    np.subtract(u, x, out=d)
+    u += x
+    u *= n_inv
+    np.multiply(d, int(tables["psi_inv_rev"][1])*n_inv % mod, out=x)
+    w = w.reshape(w.shape[:-2] + (n,))
+    np.subtract(v, w, out=w)
+    w %= mod
+    w -= mod//2
+    np.abs(w, out=w)
+    t = w.reshape(w.shape[:-1] + (n//256, 256)).sum(axis=-2) - (n//256)*mod//4
+    return np.packbits(t < 0, axis=-1, bitorder="little")
+
+# Packs an (..., n) array of 3-bit values into an (..., 3n/8) uint8 array: every group of 8 values
+# is shifted into one 24-bit integer, whose 3 low bytes are the packed group
+def Pack3_numpy(t):
+    t = np.asarray(t, dtype=np.uint32)
+    lead, n = t.shape[:-1], t.shape[-1]
+    x = (t.reshape(lead + (n//8, 8)) << np.arange(0, 24, 3, dtype=np.uint32)).sum(axis=-1,
+                                                                                  dtype=np.uint32)
+    h = x.astype("<u4").view(np.uint8).reshape(lead + (n//8, 4))[..., 0:3]
+    return h.reshape(lead + (3*n//8,))
+
+# Unpacks an (..., 3n/8) uint8 array into an (..., n) array of 3-bit values
+def Unpack3_numpy(h):
+    h = np.asarray(h, dtype=np.uint32)
+    lead, m = h.shape[:-1], h.shape[-1]
+    h = h.reshape(lead + (m//3, 3))
+    x = h[..., 0] | (h[..., 1] << 8) | (h[..., 2] << 16)
+    t = (x[..., None] >> np.arange(0, 24, 3, dtype=np.uint32)) & 7
+    return t.reshape(lead + (8*m//3,))
+
+# Array version of Compress: the rounding and packing of all 128 groups run at once
+def Compress_numpy(v):
+    t = np.asarray(v, dtype=np.int32) % NEWHOPE_Q
+    return Pack3_numpy(((t << 3) + NEWHOPE_Q//2)//NEWHOPE_Q & 7).tobytes()
+
+# Array version of Decompress. h may be any buffer or a uint8 array.
+def Decompress_numpy(h):
+    if not isinstance(h, np.ndarray):
+        h = np.frombuffer(AsBuffer(h), dtype=np.uint8)
+    r = Unpack3_numpy(h)
+    return ((r*NEWHOPE_Q + 4) >> 3).astype(np.uint16)
+
+# The sample table as an array, indexed by the 16-bit values of the SHAKE-256 output
+def SampleTableArray():
+    return DerivedTable("sample", "numpy", lambda table: np.frombuffer(table, dtype=np.uint16))
+
+# Pure-Python implementations, kept as the fallback backend
+Poly_mul_python, Poly_add_python, PolySubtract_python = Poly_mul, Poly_add, PolySubtract
+NTT_python, INTT_python = NTT, INTT
+EncodeMsg_python, DecodeMsg_python = EncodeMsg, DecodeMsg
+EncodePoly_python, DecodePoly_python = EncodePoly, DecodePoly
+Compress_python, Decompress_python = Compress, Decompress
+PolyMulAdd_python, INTTAddCompress_python = PolyMulAdd, INTTAddCompress
+INTTSubtractDecode_python = INTTSubtractDecode
+
+if BACKEND == "numpy":
+    Poly_mul, Poly_add, PolySubtract = Poly_mul_numpy, Poly_add_numpy, PolySubtract_numpy
+    NTT, INTT = NTT_numpy, INTT_numpy
+    EncodeMsg, DecodeMsg = EncodeMsg_numpy, DecodeMsg_numpy
+    EncodePoly, DecodePoly = EncodePoly_numpy, DecodePoly_numpy
+    Compress, Decompress = Compress_numpy, Decompress_numpy
+    PolyMulAdd, INTTAddCompress = PolyMulAdd_numpy, INTTAddCompress_numpy
+    INTTSubtractDecode = INTTSubtractDecode_numpy
+
+# Domains of a Poly: the coefficients of the polynomial, or its negacyclic NTT
+POLY_NORMAL = "normal"
+POLY_NTT = "ntt"
+
+# A polynomial of Z_q[x]/(x^n + 1) whose coefficients, reduced mod q, are held in one compact
+# buffer: a uint16 NumPy array with the numpy backend and an array("H") with the python backend.
+# +=, -= and *= update that buffer in place. Every Poly is tagged with its domain, and arithmetic
+# between polynomials of different domains or parameter sets raises ValueError. The pointwise
+# product *= is only allowed in the NTT domain, where it is the product of the polynomials.
+# The coefficients are exported without copying through view(), a uint16 memoryview, and
+# __array__ for NumPy. memoryview(poly) itself needs Python 3.12+ (__buffer__); before that view()
+# is the way to get the buffer. PKEGen, Encrypt and Decrypt do not use Poly: their fused kernels
+# work on arrays and bytes, and Poly is the type for code that does its own polynomial arithmetic.
+class Poly:
+    __slots__ = ("coeffs", "domain", "params")
+    __hash__ = None
+
+    def __init__(self, coeffs, domain=POLY_NORMAL, params=NewHope1024):
+        if domain not in (POLY_NORMAL, POLY_NTT):
+            raise ValueError("Unknown polynomial domain {!r}".format(domain))
+        if len(coeffs) != params.n:
+            raise ValueError("{} coefficients given for {}".format(len(coeffs), params.name))
+        if BACKEND == "numpy":
+            self.coeffs = (np.asarray(coeffs, dtype=np.int64) % params.q).astype(np.uint16)
+        else:
+            self.coeffs = array("H", [x % params.q for x in ToList(coeffs)])
+        self.domain = domain
+        self.params = params
+
+    # Returns a Poly that takes ownership of coeffs, a buffer of the active backend that is
+    # already reduced mod q
+    @classmethod
+    def wrap(cls, coeffs, domain, params):
+        poly = cls.__new__(cls)
+        poly.coeffs = coeffs
+        poly.domain = domain
+        poly.params = params
+        return poly
+
+    @classmethod
+    def zeros(cls, domain=POLY_NORMAL, params=NewHope1024):
+        if BACKEND == "numpy":
+            return cls.wrap(np.zeros(params.n, dtype=np.uint16), domain, params)
+        return cls.wrap(array("H", bytes(2*params.n)), domain, params)
+
+    # Decodes a polynomial encoded by to_bytes (the 14-bit packing of EncodePoly)
+    @classmethod
+    def from_bytes(cls, v, domain=POLY_NTT, params=NewHope1024):
+        coeffs = DecodePoly(v)
+        if len(coeffs) != params.n:
+            raise ValueError("{} coefficients given for {}".format(len(coeffs), params.name))
+        # 14-bit coefficients can be up to 16383, above q
+        if BACKEND == "numpy":
+            coeffs %= params.q
+        else:
+            coeffs = array("H", [x % params.q for x in coeffs])
+        return cls.wrap(coeffs, domain, params)
+
+    def to_bytes(self):
+        return EncodePoly(self.coeffs)
+
+    def copy(self):
+        return Poly.wrap(self.coeffs.copy() if BACKEND == "numpy" else array("H", self.coeffs),
+                         self.domain, self.params)
+
+    def tolist(self):
+        return self.coeffs.tolist()
+
+    def view(self):
+        return memoryview(self.coeffs)
+
+    def __buffer__(self, flags):
+        return memoryview(self.coeffs)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.coeffs, dtype=dtype)
+
+    def __len__(self):
+        return len(self.coeffs)
+
+    def __getitem__(self, i):
+        return self.coeffs[i]
+
+    def __iter__(self):
+        return iter(self.coeffs)
+
+    def __eq__(self, other):
+        if not isinstance(other, Poly):
+            return NotImplemented
+        return (self.domain == other.domain and self.params is other.params
+                and self.tolist() == other.tolist())
+
+    def __repr__(self):
+        return "Poly({}, {}, [{}, ...])".format(self.params.name, self.domain,
+                                                ", ".join(map(str, self.tolist()[:4])))
+
+    # Returns the NTT of a normal-domain polynomial
+    def ntt(self):
+        if self.domain != POLY_NORMAL:
+            raise ValueError("Polynomial is already in the NTT domain")
+        return self.transform(NTT, POLY_NTT)
 
-    debug("Creating publicseed and noiseseed")
+    # Returns the normal-domain polynomial of an NTT-domain one
+    def intt(self):
+        if self.domain != POLY_NTT:
+            raise ValueError("Polynomial is not in the NTT domain")
+        return self.transform(INTT, POLY_NORMAL)
+
+    def transform(self, fn, domain):
+        coeffs = fn(self.coeffs, self.params.root, self.params.q)
+        if BACKEND != "numpy":
+            coeffs = array("H", coeffs)
+        return Poly.wrap(coeffs, domain, self.params)
+
+    def check_operand(self, other):
+        if not isinstance(other, Poly):
+            raise TypeError("Expected a Poly, got {}".format(type(other).__name__))
+        if other.params is not self.params:
+            raise ValueError("Cannot mix {} and {} polynomials".format(self.params.name,
+                                                                       other.params.name))
+        if other.domain != self.domain:
+            raise ValueError("Cannot mix {} and {} domain polynomials".format(self.domain,
+                                                                              other.domain))
+
+    # a + b and a - b are below 2q < 2^16, so the sums stay in uint16 and are reduced by one
+    # conditional subtraction
+    def __iadd__(self, other):
+        self.check_operand(other)
+        a, b, q = self.coeffs, other.coeffs, self.params.q
+        if BACKEND == "numpy":
+            a += b
+            np.subtract(a, q, out=a, where=a >= q)
+        else:
+            for i in range(len(a)):
+                x = a[i] + b[i]
+                a[i] = x - q if x >= q else x
+        return self
+
+    def __isub__(self, other):
+        self.check_operand(other)
+        a, b, q = self.coeffs, other.coeffs, self.params.q
+        if BACKEND == "numpy":
+            a += q
+            a -= b
+            np.subtract(a, q, out=a, where=a >= q)
+        else:
+            for i in range(len(a)):
+                x = a[i] - b[i]
+                a[i] = x + q if x < 0 else x
+        return self
+
+    # The products are below q^2 < 2^32, so the NumPy version goes through one uint32 buffer
+    def __imul__(self, other):
+        self.check_operand(other)
+        if self.domain != POLY_NTT:
+            raise ValueError("The pointwise product is only the polynomial product in the NTT domain")
+        a, b, q = self.coeffs, other.coeffs, self.params.q
+        if BACKEND == "numpy":
+            w = a.astype(np.uint32)
+            w *= b
+            w %= q
+            a[:] = w
+        else:
+            for i in range(len(a)):
+                a[i] = a[i]*b[i] % q
+        return self
+
+    def __add__(self, other):
+        c = self.copy()
+        c += other
+        return c
+
+    def __sub__(self, other):
+        c = self.copy()
+        c -= other
+        return c
+
+    def __mul__(self, other):
+        c = self.copy()
+        c *= other
+        return c
+
+# Generates the public and private key. The 32-byte seed is random unless one is given.
+def PKEGen(seed=None, params=NewHope1024):
+
+    # Generate the 32-byte random seed
+    if seed is None:
+        seed = os.urandom(32)
+
+    # Creating publicseed and noiseseed
     z = hashlib.shake_256(seed).digest(64)
     publicseed = z[0:32]
     noiseseed = z[32:]
 
-    debug("Generating polynomial a_hat")
-    a_hat = GenA(publicseed)
-
-    debug("Sampling polynomial s")
-    s = Sample(noiseseed, 0)
+    # Generating polynomial a_hat
+    a_hat = GenA(publicseed, params)
 
-    debug("Computing s_hat = NTT of s")
-    s_hat = NTT(s, NEWHOPE_ROOT, NEWHOPE_Q)
+    # Sampling polynomial s
+    s = Sample(noiseseed, 0, params)
 
-    debug("Sampling polynomial e")
-    e = Sample(noiseseed, 1)
+    # Computing s_hat = NTT of s
+    s_hat = NTT(s, params.root, params.q)
 
-    debug("Computing e_hat = NTT of e")
-    e_hat = NTT(e, NEWHOPE_ROOT, NEWHOPE_Q)
+    # Sampling polynomial e
+    e = Sample(noiseseed, 1, params)
 
-    debug("Computing ahat_shat")
-    ahat_shat = Poly_mul(a_hat, s_hat)
+    # Computing e_hat = NTT of e
+    e_hat = NTT(e, params.root, params.q)
 
-    debug("Computing b_hat = a_hat dot s_hat + e_hat")
-    b_hat = Poly_add(ahat_shat, e_hat)
+    # Computing b_hat = a_hat dot s_hat + e_hat
+    b_hat = PolyMulAdd(a_hat, s_hat, e_hat, params.q)
 
-    debug("Computing public key pk")
+    # Computing public key pk
     pk = EncodePK(b_hat, publicseed)
 
-    debug("Computing secret key sk")
+    # Computing secret key sk
     sk = EncodePoly(s_hat)
 
-    debug("Public key generation complete. Returning keys")
-
     return pk, sk
 
-# Encrypts a message and returns a ciphertext
-def Encrypt(pk, m, coin):
-    print("========================== Encrypting Message ==========================")
-    b_hat, publicseed = DecodePK(pk)
-    a_hat = GenA(publicseed)
+# A public key with b_hat decoded and a_hat expanded from the public seed, so that encrypting to
+# it skips DecodePK and GenA. Encrypt accepts it in place of the encoded public key, with the
+# parameter set it was prepared for.
+class PreparedPublicKey:
+    __slots__ = ("pk", "b_hat", "publicseed", "a_hat", "params")
+
+    def __init__(self, pk, b_hat, publicseed, a_hat, params=NewHope1024):
+        self.pk = pk
+        self.b_hat = b_hat
+        self.publicseed = publicseed
+        self.a_hat = a_hat
+        self.params = params
+
+    # Raises ValueError unless the key was prepared for params
+    def check(self, params):
+        if self.params is not params:
+            raise ValueError("Public key prepared for {} used with {}".format(self.params.name,
+                                                                             params.name))
+        return self
+
+# Raises ValueError unless pk is an encoded public key of params
+def CheckPublicKeyLength(pk, params):
+    if len(pk) != params.pk_bytes:
+        raise ValueError("{}-byte public key given for {}".format(len(pk), params.name))
+
+# Decodes the public key and expands a_hat once
+def PreparePublicKey(pk, params=NewHope1024):
+    if isinstance(pk, PreparedPublicKey):
+        return pk.check(params)
+    CheckPublicKeyLength(pk, params)
+    b_hat, publicseed = DecodePK(pk, params)
+    return PreparedPublicKey(bytes(pk), b_hat, bytes(publicseed), GenA(publicseed, params), params)
+
+# Prepares a list of public keys at once, using the batched decoding and GenA with the numpy backend
+def PreparePublicKeys(pks, params=NewHope1024):
+    if not pks:
+        return []
+    if BACKEND != "numpy" or any(isinstance(pk, PreparedPublicKey) for pk in pks):
+        return [PreparePublicKey(pk, params) for pk in pks]
+    pks = [AsBuffer(pk) for pk in pks]
+    for pk in pks:
+        CheckPublicKeyLength(pk, params)
+    publicseeds = [bytes(pk[params.poly_bytes:]) for pk in pks]
+    b_hat = DecodePolyBatch([pk[0:params.poly_bytes] for pk in pks])
+    a_hat = GenABatch(publicseeds, params)
+    return [PreparedPublicKey(bytes(pk), b_hat[i].copy(), publicseeds[i], a_hat[i].copy(), params)
+            for (i, pk) in enumerate(pks)]
+
+# Least-recently-used cache of prepared public keys, keyed by the parameter set name and the encoded
+# public key. A maxsize of 0 disables caching.
+class PublicKeyCache:
+
+    def __init__(self, maxsize=PK_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the prepared public key, preparing and caching it on a miss
+    def get(self, pk, params=NewHope1024):
+        return self.get_many([pk], params)[0]
+
+    # Returns the prepared public keys for a list of public keys. The misses are prepared together.
+    def get_many(self, pks, params=NewHope1024):
+        keys = [(params.name, pk.pk if isinstance(pk, PreparedPublicKey) else bytes(pk))
+                for pk in pks]
+        found = [None]*len(pks)
+        missing = []
+        with self.lock:
+            for (i, key) in enumerate(keys):
+                if isinstance(pks[i], PreparedPublicKey):
+                    found[i] = pks[i].check(params)
+                elif key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[i] = self.entries[key]
+                    self.hits += 1
+                else:
+                    missing.append(i)
+                    self.misses += 1
+        if not missing:
+            return found
+
+        # Keys repeated within the batch are only prepared once
+        unique = list(OrderedDict.fromkeys(keys[i] for i in missing))
+        prepared = dict(zip(unique, PreparePublicKeys([pk for (name, pk) in unique], params)))
+        for i in missing:
+            found[i] = prepared[keys[i]]
+        with self.lock:
+            for (key, ppk) in prepared.items():
+                self.put(key, ppk)
+        return found
+
+    # Adds an entry, evicting the least recently used ones beyond maxsize. The lock must be held.
+    def put(self, key, ppk):
+        if self.maxsize <= 0:
+            return
+        self.entries[key] = ppk
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
 
-    s_prime = Sample(coin, 0)
-    e_prime = Sample(coin, 1)
-    e_prime_prime = Sample(coin, 2)
+    # Changes the maximum number of entries, evicting as needed
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > max(maxsize, 0):
+                self.entries.popitem(last=False)
+                self.evictions += 1
 
-    t_hat = NTT(s_prime, NEWHOPE_ROOT, NEWHOPE_Q)
-    e_prime_ntt = NTT(e_prime, NEWHOPE_ROOT, NEWHOPE_Q)
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
 
-    ahat_that = Poly_mul(a_hat, t_hat)
-    u_hat = Poly_add(ahat_that, e_prime_ntt)
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
 
-    v = EncodeMsg(m)
+# Cache used by Encrypt and EncryptBatch
+pk_cache = PublicKeyCache()
 
-    bhat_that = Poly_mul(b_hat, t_hat)
-    ntt_temp = INTT(bhat_that, NEWHOPE_ROOT, NEWHOPE_Q)
+# Encrypts a message and returns a ciphertext. pk is an encoded or prepared public key.
+def Encrypt(pk, m, coin, params=NewHope1024):
+    if isinstance(pk, PreparedPublicKey):
+        pk.check(params)
+    else:
+        pk = pk_cache.get(pk, params)
+    b_hat = pk.b_hat
+    a_hat = pk.a_hat
 
-    sum1 = Poly_add(ntt_temp, e_prime_prime)
-    v_prime = Poly_add(sum1, v)
-    h = Compress(v_prime)
+    s_prime = Sample(coin, 0, params)
+    e_prime = Sample(coin, 1, params)
+    e_prime_prime = Sample(coin, 2, params)
+
+    t_hat = NTT(s_prime, params.root, params.q)
+    e_prime_ntt = NTT(e_prime, params.root, params.q)
+
+    u_hat = PolyMulAdd(a_hat, t_hat, e_prime_ntt, params.q)
+
+    v = EncodeMsg(m, params)
+
+    # Compress(INTT(b_hat*t_hat) + e_prime_prime + v)
+    h = INTTAddCompress(b_hat, t_hat, e_prime_prime, v, params.root, params.q)
     c = EncodeC(u_hat, h)
     return c
 
-# Decrypts a ciphertext
-def Decrypt(c, sk):
-    print("========================== Decrypting Message ==========================")
-    u_hat, h = DecodeC(c)
+# A secret key with s_hat decoded once, held as a uint16 array (a NumPy array with the numpy
+# backend). Decrypt accepts it in place of the encoded secret key.
+class PreparedSecretKey:
+    __slots__ = ("s_hat",)
+
+    def __init__(self, s_hat):
+        self.s_hat = s_hat
+
+# Decodes the secret key once
+def PrepareSecretKey(sk):
+    if isinstance(sk, PreparedSecretKey):
+        return sk
     s_hat = DecodePoly(sk)
+    if BACKEND != "numpy":
+        s_hat = array("H", s_hat)
+    return PreparedSecretKey(s_hat)
+
+# Decrypts a ciphertext. sk is an encoded or prepared secret key.
+def Decrypt(c, sk, params=NewHope1024):
+    u_hat, h = DecodeC(c, params)
+    if isinstance(sk, PreparedSecretKey):
+        s_hat = sk.s_hat
+    else:
+        s_hat = DecodePoly(sk)
     v_prime = Decompress(h)
 
-    us_product = Poly_mul(u_hat, s_hat)
-    inv_product = INTT(us_product, NEWHOPE_ROOT, NEWHOPE_Q)
-    v_sub = PolySubtract(v_prime, inv_product)
-    m = DecodeMsg(v_sub)
+    # DecodeMsg(v_prime - INTT(u_hat*s_hat))
+    m = INTTSubtractDecode(u_hat, s_hat, v_prime, params.root, params.q)
+    if BACKEND == "numpy":
+        m = m.tolist()
     return m
 
+# Batched API. With the numpy backend the polynomials of N key pairs, messages or ciphertexts are
+# packed into an (N, n) array and every step runs once over the whole batch. The results
+# are identical to calling PKEGen, Encrypt and Decrypt on each item in turn, which is what the
+# python backend does.
+
+# GenA for a list of public seeds. The SHAKE-128 blocks of all seeds are parsed together.
+def GenABatch(publicseeds, params=NewHope1024):
+    extseed = bytearray(33)
+    bufs = []
+    for publicseed in publicseeds:
+        extseed[0:32] = publicseed[0:32]
+        for i in range(0, (params.n//64)):
+            extseed[32] = i
+            bufs.append(hashlib.shake_128(extseed).digest(SQUEEZE_BLOCK_SIZE))
+    if instruments.enabled:
+        instruments.hashed(SQUEEZE_BLOCK_SIZE*len(bufs))
+    vals = np.frombuffer(b"".join(bufs), dtype="<u2").reshape(-1, SQUEEZE_BLOCK_SIZE//2)
+    keep = vals < (5*NEWHOPE_Q)
+    # A stable sort moves the accepted values of each block to the front, in order
+    order = np.argsort(~keep, axis=1, kind="stable")[:, :64]
+    a = np.take_along_axis(vals, order, axis=1)
+    for row in np.flatnonzero(keep.sum(axis=1) < 64):
+        # Rarely the first block has fewer than 64 values below 5q and more blocks are squeezed
+        extseed[0:32] = publicseeds[row // (params.n//64)][0:32]
+        extseed[32] = row % (params.n//64)
+        a[row] = GenABlock(extseed)
+    return (a % NEWHOPE_Q).reshape(len(publicseeds), params.n).astype(np.uint16)
+
+# Sample for a list of noise seeds with the same nonce
+def SampleBatch(noiseseeds, nonce, params=NewHope1024):
+    extseed = bytearray(34)
+    extseed[32] = nonce
+    bufs = []
+    for noiseseed in noiseseeds:
+        extseed[0:32] = noiseseed[0:32]
+        for i in range(0, (params.n//64)):
+            extseed[33] = i
+            bufs.append(hashlib.shake_256(extseed).digest(128))
+    if instruments.enabled:
+        instruments.hashed(128*len(bufs))
+    buf = np.frombuffer(b"".join(bufs), dtype="<u2").reshape(len(noiseseeds), params.n)
+    return SampleTableArray()[buf]
+
+# EncodePoly for an (N, n) array, returns an (N, 7n/4) uint8 array
+def EncodePolyBatch(s):
+    s = np.asarray(s, dtype=np.int32)
+    n = s.shape[-1]
+    t = (s % NEWHOPE_Q).reshape(-1, n//4, 4)
+    t0, t1, t2, t3 = t[..., 0], t[..., 1], t[..., 2], t[..., 3]
+    r = np.stack((t0 & 0xff,
+                  (t0 >> 8) | ((t1 << 6) & 0xff),
+                  (t1 >> 2) & 0xff,
+                  (t1 >> 10) | ((t2 << 4) & 0xff),
+                  (t2 >> 4) & 0xff,
+                  (t2 >> 12) | ((t3 << 2) & 0xff),
+                  (t3 >> 6) & 0xff), axis=-1)
+    return r.reshape(-1, 7*n//4).astype(np.uint8)
+
+# DecodePoly for an (N, 7n/4) array or a list of N encoded polynomials, returns an (N, n) array
+def DecodePolyBatch(v):
+    if len(v) == 0:
+        return np.zeros((0, 0), dtype=np.uint16)
+    if not isinstance(v, np.ndarray):
+        v = np.frombuffer(b"".join(AsBuffer(row) for row in v), dtype=np.uint8).reshape(len(v), -1)
+    n = 4*(v.shape[-1]//7)
+    v = v.astype(np.int32).reshape(-1, n//4, 7)
+    r = np.stack((v[..., 0] | ((v[..., 1] & 0x3f) << 8),
+                  (v[..., 1] >> 6) | (v[..., 2] << 2) | ((v[..., 3] & 0x0f) << 10),
+                  (v[..., 3] >> 4) | (v[..., 4] << 4) | ((v[..., 5] & 0x03) << 12),
+                  (v[..., 5] >> 2) | (v[..., 6] << 6)), axis=-1)
+    return r.reshape(-1, n).astype(np.uint16)
+
+# EncodeMsg for a list of 32-byte messages
+def EncodeMsgBatch(msgs, params=NewHope1024):
+    m = np.frombuffer(b"".join(bytes(m) for m in msgs), dtype=np.uint8).reshape(-1, 32)
+    bits = np.unpackbits(m, axis=1, bitorder="little").astype(np.uint16)
+    return np.tile(bits*(NEWHOPE_Q//2), (1, params.n//256))
+
+# DecodeMsg for an (N, n) array, returns a list of messages
+def DecodeMsgBatch(v):
+    t = np.abs(np.asarray(v, dtype=np.int32) % NEWHOPE_Q - NEWHOPE_Q//2)
+    copies = t.shape[-1]//256
+    t = t.reshape(-1, copies, 256).sum(axis=1) - copies*NEWHOPE_Q//4
+    return np.packbits(t < 0, axis=1, bitorder="little").tolist()
+
+# Compress for an (N, n) array, returns an (N, 3n/8) uint8 array
+def CompressBatch(v):
+    t = np.atleast_2d(np.asarray(v, dtype=np.int32)) % NEWHOPE_Q
+    return Pack3_numpy(((t << 3) + NEWHOPE_Q//2)//NEWHOPE_Q & 7)
+
+# Decompress for an (N, 3n/8) array, returns an (N, n) array
+def DecompressBatch(h):
+    return Decompress_numpy(np.atleast_2d(np.asarray(h, dtype=np.uint8)))
+
+# Raises ValueError unless the lists of a batch have the same length
+def CheckBatchLengths(**lists):
+    lengths = {name: len(v) for (name, v) in lists.items()}
+    if len(set(lengths.values())) > 1:
+        raise ValueError("Batch lengths differ: " +
+                         ", ".join("{} {}".format(len(v), name) for (name, v) in lists.items()))
+
+# Generates n key pairs and returns the lists of public and secret keys. The 32-byte seeds are
+# random unless they are given.
+def PKEGenBatch(n, seeds=None, params=NewHope1024):
+    if seeds is None:
+        seeds = [os.urandom(32) for _ in range(n)]
+    if len(seeds) != n:
+        raise ValueError("{} seeds given for {} key pairs".format(len(seeds), n))
+    if n == 0:
+        return [], []
+    if BACKEND != "numpy":
+        keys = [PKEGen(seed, params) for seed in seeds]
+        return [pk for (pk, sk) in keys], [sk for (pk, sk) in keys]
+
+    z = [hashlib.shake_256(seed).digest(64) for seed in seeds]
+    publicseeds = [zz[0:32] for zz in z]
+    noiseseeds = [zz[32:] for zz in z]
+
+    a_hat = GenABatch(publicseeds, params)
+    s_hat = NTT(SampleBatch(noiseseeds, 0, params), params.root, params.q)
+    e_hat = NTT(SampleBatch(noiseseeds, 1, params), params.root, params.q)
+    b_hat = PolyMulAdd(a_hat, s_hat, e_hat, params.q)
+
+    seeds = np.frombuffer(b"".join(publicseeds), dtype=np.uint8).reshape(-1, 32)
+    pks = [row.tobytes() for row in np.concatenate((EncodePolyBatch(b_hat), seeds), axis=1)]
+    sks = [row.tobytes() for row in EncodePolyBatch(s_hat)]
+    return pks, sks
+
+# Encrypts msgs[i] to pks[i] with coins[i] and returns the list of ciphertexts. The public keys
+# may be encoded or prepared.
+def EncryptBatch(pks, msgs, coins, params=NewHope1024):
+    CheckBatchLengths(pks=pks, msgs=msgs, coins=coins)
+    if not pks:
+        return []
+    if BACKEND != "numpy":
+        return [Encrypt(pk, m, coin, params) for (pk, m, coin) in zip(pks, msgs, coins)]
+
+    ppks = pk_cache.get_many(pks, params)
+    b_hat = np.stack([ppk.b_hat for ppk in ppks])
+    a_hat = np.stack([ppk.a_hat for ppk in ppks])
+
+    t_hat = NTT(SampleBatch(coins, 0, params), params.root, params.q)
+    e_prime_ntt = NTT(SampleBatch(coins, 1, params), params.root, params.q)
+    e_prime_prime = SampleBatch(coins, 2, params)
+
+    u_hat = PolyMulAdd(a_hat, t_hat, e_prime_ntt, params.q)
+    h = INTTAddCompress(b_hat, t_hat, e_prime_prime, EncodeMsgBatch(msgs, params), params.root,
+                        params.q)
+    return [row.tobytes() for row in np.concatenate((EncodePolyBatch(u_hat), h), axis=1)]
+
+# Decrypts cs[i] with sks[i] and returns the list of messages. The secret keys may be encoded or
+# prepared.
+def DecryptBatch(cs, sks, params=NewHope1024):
+    CheckBatchLengths(cs=cs, sks=sks)
+    if not cs:
+        return []
+    if BACKEND != "numpy":
+        return [Decrypt(c, sk, params) for (c, sk) in zip(cs, sks)]
+
+    c = np.frombuffer(b"".join(AsBuffer(c) for c in cs), dtype=np.uint8)
+    c = c.reshape(-1, params.ct_bytes)
+    u_hat = DecodePolyBatch(c[:, 0:params.poly_bytes])
+    if any(isinstance(sk, PreparedSecretKey) for sk in sks):
+        s_hat = np.stack([PrepareSecretKey(sk).s_hat for sk in sks])
+    else:
+        s_hat = DecodePolyBatch(sks)
+    v_prime = DecompressBatch(c[:, params.poly_bytes:])
+    return INTTSubtractDecode(u_hat, s_hat, v_prime, params.root, params.q).tolist()
+
+# Hybrid encryption of streams of any length. A random 32-byte key is encrypted with Encrypt, and
+# SHAKE-256 derives a keystream and an authentication key from it. The stream is
+#   STREAM_MAGIC | c | nonce | chunk size | chunk | chunk | ...
+# where the chunk size is 4 bytes big-endian and each chunk is a 4-byte big-endian plaintext
+# length (the top bit marks the last chunk), the encrypted data and a 32-byte tag over the chunk
+# index, length and encrypted data. Every stream ends with a chunk marked last, so truncation is
+# detected. Only one chunk is held in memory at a time, whatever the length of the stream: the
+# chunk size is at most STREAM_MAX_CHUNK_SIZE, it is authenticated with the rest of the header,
+# and a chunk longer than it is refused before it is read.
+STREAM_MAGIC = b"NHS2"
+STREAM_CHUNK_SIZE = 1 << 16
+STREAM_MAX_CHUNK_SIZE = 1 << 24
+STREAM_NONCE_BYTES = 16
+STREAM_TAG_BYTES = 32
+STREAM_LAST = 1 << 31
+STREAM_FRAME = struct.Struct(">I")
+
+# Returns the keystream key and the authentication key for a stream. They depend on the whole
+# header, so a header cannot be swapped onto another stream.
+def StreamKeys(m, header):
+    z = hashlib.shake_256(b"NewHope stream" + bytes(m) + header).digest(64)
+    return z[0:32], z[32:64]
+
+# XORs data with the keystream of chunk index
+def StreamXOR(enckey, index, data):
+    keystream = hashlib.shake_256(enckey + index.to_bytes(8, "little")).digest(len(data))
+    x = int.from_bytes(data, "little") ^ int.from_bytes(keystream, "little")
+    return x.to_bytes(len(data), "little")
+
+# Returns the tag of encrypted chunk index
+def StreamTag(mackey, index, frame, data):
+    return hashlib.shake_256(mackey + index.to_bytes(8, "little") + frame + data).digest(STREAM_TAG_BYTES)
+
+# Reads up to size bytes, reading again after short reads from pipes and sockets
+def ReadFull(src, size):
+    data = src.read(size)
+    if not data or len(data) == size:
+        return data
+    parts = [data]
+    got = len(data)
+    while got < size:
+        more = src.read(size - got)
+        if not more:
+            break
+        parts.append(more)
+        got += len(more)
+    return b"".join(parts)
+
+# Yields (chunk, last) for the contents of src. Reads one chunk ahead so that the last chunk is
+# known without seeking.
+def StreamChunks(src, size=STREAM_CHUNK_SIZE):
+    data = ReadFull(src, size)
+    while True:
+        ahead = ReadFull(src, size) if len(data) == size else b""
+        yield data, not ahead
+        if not ahead:
+            return
+        data = ahead
+
+# Encrypts the binary file object src to pk and writes the stream to dst. Returns the number of
+# bytes encrypted.
+def EncryptStream(pk, src, dst, chunk_size=STREAM_CHUNK_SIZE, params=NewHope1024):
+    if not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE:
+        raise ValueError("Chunk size must be between 1 and {}".format(STREAM_MAX_CHUNK_SIZE))
+    CheckLengths([(AsBuffer(pk), params.pk_bytes, "Public key")])
+    m = os.urandom(32)
+    header = (STREAM_MAGIC + Encrypt(pk, m, os.urandom(32), params) + os.urandom(STREAM_NONCE_BYTES)
+              + STREAM_FRAME.pack(chunk_size))
+    enckey, mackey = StreamKeys(m, header)
+    dst.write(header)
+
+    total = 0
+    for (index, (data, last)) in enumerate(StreamChunks(src, chunk_size)):
+        frame = STREAM_FRAME.pack(len(data) | (STREAM_LAST if last else 0))
+        data = StreamXOR(enckey, index, data)
+        dst.write(frame)
+        dst.write(data)
+        dst.write(StreamTag(mackey, index, frame, data))
+        total += len(data)
+    return total
+
+# Decrypts a stream written by EncryptStream from src with sk and writes the data to dst. Each
+# chunk is checked before it is written; raises ValueError if the stream is not a NewHope stream,
+# was modified, was truncated, has a chunk longer than its chunk size or has data after its last
+# chunk. Returns the number of bytes decrypted.
+def DecryptStream(sk, src, dst, params=NewHope1024):
+    header_size = len(STREAM_MAGIC) + params.ct_bytes + STREAM_NONCE_BYTES + STREAM_FRAME.size
+    header = ReadFull(src, header_size)
+    if header[0:len(STREAM_MAGIC)] != STREAM_MAGIC:
+        raise ValueError("Not a NewHope stream")
+    if len(header) < header_size:
+        raise ValueError("Stream is truncated")
+    chunk_size = STREAM_FRAME.unpack(header[-STREAM_FRAME.size:])[0]
+    if not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE:
+        raise ValueError("Stream chunk size {} is out of range".format(chunk_size))
+    c = header[len(STREAM_MAGIC):len(STREAM_MAGIC) + params.ct_bytes]
+    enckey, mackey = StreamKeys(Decrypt(c, sk, params), header)
+
+    total = 0
+    index = 0
+    while True:
+        frame = ReadFull(src, STREAM_FRAME.size)
+        if len(frame) < STREAM_FRAME.size:
+            raise ValueError("Stream is truncated")
+        size = STREAM_FRAME.unpack(frame)[0]
+        last, size = size & STREAM_LAST, size & ~STREAM_LAST
+        if size > chunk_size:
+            raise ValueError("Stream chunk {} is longer than the chunk size".format(index))
+        data = ReadFull(src, size)
+        tag = ReadFull(src, STREAM_TAG_BYTES)
+        if len(data) < size or len(tag) < STREAM_TAG_BYTES:
+            raise ValueError("Stream is truncated")
+        if not hmac.compare_digest(tag, StreamTag(mackey, index, frame, data)):
+            raise ValueError("Stream chunk {} failed authentication".format(index))
+        dst.write(StreamXOR(enckey, index, data))
+        total += size
+        index += 1
+        if last:
+            if src.read(1):
+                raise ValueError("Stream has data after its last chunk")
+            return total
+
+encrypt_stream = EncryptStream
+decrypt_stream = DecryptStream
+
+# On-disk store of encoded key pairs. The data file is a header followed by fixed-size records
+#   key ID (16 bytes) | pk | sk
+# numbered from 0 in the order they were appended. It is memory-mapped, so a record is found by
+# its offset without reading the file, and pk and sk are handed out as memoryview slices of the
+# mapping that DecodePK, DecodePoly, Encrypt and Decrypt read in place. The key ID is chosen by the
+# caller or defaults to KeyID(pk). The index file next to it (path + ".idx") is a memory-mapped
+# open-addressing hash table from key ID to record number, rebuilt from the records if it is
+# missing or stale.
+KEYSTORE_MAGIC = b"NHKS"
+KEYSTORE_VERSION = 1
+KEYSTORE_HEADER = struct.Struct("<4sH2x16sQ")       # magic, version, parameter set name, count
+KEYSTORE_ID_BYTES = 16
+KEYSTORE_INITIAL_CAPACITY = 1024                    # records
+INDEX_MAGIC = b"NHKI"
+INDEX_HEADER = struct.Struct("<4sH2xQQ")            # magic, version, slots, used
+INDEX_SLOT = struct.Struct("<16sQ")                 # key ID, record number + 1 (0 for empty)
+
+# Default key ID of a public key: the first 16 bytes of its SHA-256 hash
+def KeyID(pk):
+    return hashlib.sha256(AsBuffer(pk)).digest()[0:KEYSTORE_ID_BYTES]
+
+class KeyStore:
+
+    # Opens the store at path, creating it if it does not exist. An existing store keeps the
+    # parameter set it was created with; ValueError is raised if params names a different one.
+    def __init__(self, path, params=None):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "r+b" if exists else "w+b")
+        if exists:
+            header = self.file.read(KEYSTORE_HEADER.size)
+            if len(header) < KEYSTORE_HEADER.size:
+                self.file.close()
+                raise ValueError("Not a NewHope key store: {}".format(path))
+            magic, version, name, self.count = KEYSTORE_HEADER.unpack(header)
+            name = name.rstrip(b"\0").decode("ascii", "replace")
+            if magic != KEYSTORE_MAGIC or version != KEYSTORE_VERSION or name not in PARAMETER_SETS:
+                self.file.close()
+                raise ValueError("Not a NewHope key store: {}".format(path))
+            if params is not None and params.name != name:
+                self.file.close()
+                raise ValueError("Key store {} holds {} keys, not {}".format(path, name, params.name))
+            params = GetParameterSet(name)
+        else:
+            params = params or NewHope1024
+            self.count = 0
+        self.params = params
+        self.record_size = KEYSTORE_ID_BYTES + params.pk_bytes + params.sk_bytes
+        self.data = None
+        self.index = None
+        self.map(max(self.count, KEYSTORE_INITIAL_CAPACITY))
+        self.write_header()
+        self.open_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key_id):
+        return self.find(key_id) is not None
+
+    # Maps the data file with room for capacity records. Views handed out earlier keep the old
+    # mapping alive until they are released.
+    def map(self, capacity):
+        self.capacity = capacity
+        self.file.truncate(KEYSTORE_HEADER.size + capacity*self.record_size)
+        self.data = mmap.mmap(self.file.fileno(), 0)
+
+    def write_header(self):
+        KEYSTORE_HEADER.pack_into(self.data, 0, KEYSTORE_MAGIC, KEYSTORE_VERSION,
+                                  self.params.name.encode(), self.count)
+
+    # Returns the record number of key_id, or None
+    def find(self, key_id):
+        key_id = bytes(key_id)
+        mask = self.slots - 1
+        i = IndexHash(key_id) & mask
+        while True:
+            slot_id, record = INDEX_SLOT.unpack_from(self.index, INDEX_HEADER.size + i*INDEX_SLOT.size)
+            if record == 0:
+                return None
+            if slot_id == key_id:
+                return record - 1
+            i = (i + 1) & mask
+
+    # Returns the (pk, sk) views of key_id. Raises KeyError if it is not in the store.
+    def get(self, key_id):
+        record = self.find(key_id)
+        if record is None:
+            raise KeyError(bytes(key_id).hex())
+        return self.pk(record), self.sk(record)
+
+    # Returns a view of the whole record
+    def record(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError("record {} out of range".format(i))
+        offset = KEYSTORE_HEADER.size + i*self.record_size
+        return memoryview(self.data)[offset:offset + self.record_size]
+
+    def key_id(self, i):
+        return bytes(self.record(i)[0:KEYSTORE_ID_BYTES])
+
+    def pk(self, i):
+        return self.record(i)[KEYSTORE_ID_BYTES:KEYSTORE_ID_BYTES + self.params.pk_bytes]
+
+    def sk(self, i):
+        return self.record(i)[KEYSTORE_ID_BYTES + self.params.pk_bytes:]
+
+    # Appends one key pair and returns its record number
+    def append(self, pk, sk, key_id=None):
+        return self.extend([pk], [sk], None if key_id is None else [key_id])[0]
+
+    # Appends key pairs, for example the output of PKEGenBatch or KeyPool.generate, with one write
+    # to the mapping. Returns the range of their record numbers. Raises ValueError if a key has the
+    # wrong size or a key ID is already in the store.
+    def extend(self, pks, sks, key_ids=None):
+        if key_ids is None:
+            key_ids = [KeyID(pk) for pk in pks]
+        key_ids = [bytes(key_id) for key_id in key_ids]
+        if not len(pks) == len(sks) == len(key_ids):
+            raise ValueError("pks, sks and key_ids differ in length")
+        if any(len(key_id) != KEYSTORE_ID_BYTES for key_id in key_ids):
+            raise ValueError("Key IDs are {} bytes".format(KEYSTORE_ID_BYTES))
+        if len(set(key_ids)) != len(key_ids) or any(key_id in self for key_id in key_ids):
+            raise ValueError("Duplicate key ID")
+        blob = b"".join(key_id + bytes(AsBuffer(pk)) + bytes(AsBuffer(sk))
+                        for (key_id, pk, sk) in zip(key_ids, pks, sks))
+        if len(blob) != len(key_ids)*self.record_size:
+            raise ValueError("Keys do not match the {} parameter set".format(self.params.name))
+
+        start = self.count
+        if start + len(key_ids) > self.capacity:
+            self.map(max(2*self.capacity, start + len(key_ids)))
+        offset = KEYSTORE_HEADER.size + start*self.record_size
+        self.data[offset:offset + len(blob)] = blob
+        self.count += len(key_ids)
+        self.write_header()
+
+        if 2*self.count > self.slots:
+            self.build_index()
+        else:
+            for (i, key_id) in enumerate(key_ids):
+                self.insert(key_id, start + i)
+            INDEX_HEADER.pack_into(self.index, 0, INDEX_MAGIC, KEYSTORE_VERSION, self.slots,
+                                   self.count)
+        return range(start, self.count)
+
+    # Generates n key pairs in batches and appends them. The 32-byte seeds are random unless they
+    # are given.
+    def generate(self, n, seeds=None, batch=1000):
+        if seeds is None:
+            seeds = [os.urandom(32) for _ in range(n)]
+        start = self.count
+        for i in range(0, n, batch):
+            pks, sks = PKEGenBatch(len(seeds[i:i+batch]), seeds[i:i+batch], self.params)
+            self.extend(pks, sks)
+        return range(start, self.count)
+
+    # Opens the index, rebuilding it if it is missing or does not cover every record
+    def open_index(self):
+        path = self.path + ".idx"
+        if os.path.exists(path) and os.path.getsize(path) >= INDEX_HEADER.size:
+            with open(path, "r+b") as f:
+                index = mmap.mmap(f.fileno(), 0)
+            magic, version, slots, used = INDEX_HEADER.unpack_from(index, 0)
+            if (magic == INDEX_MAGIC and version == KEYSTORE_VERSION and used == self.count
+                    and len(index) == INDEX_HEADER.size + slots*INDEX_SLOT.size):
+                self.index = index
+                self.slots = slots
+                return
+            index.close()
+        self.build_index()
+
+    # Writes a new index with at least 4 slots per record and inserts every record's key ID
+    def build_index(self):
+        slots = 1 << max(10, (4*self.count).bit_length())
+        if self.index is not None:
+            self.index.close()
+        with open(self.path + ".idx", "w+b") as f:
+            f.truncate(INDEX_HEADER.size + slots*INDEX_SLOT.size)
+            self.index = mmap.mmap(f.fileno(), 0)
+        self.slots = slots
+        for i in range(0, self.count):
+            offset = KEYSTORE_HEADER.size + i*self.record_size
+            self.insert(self.data[offset:offset + KEYSTORE_ID_BYTES], i)
+        INDEX_HEADER.pack_into(self.index, 0, INDEX_MAGIC, KEYSTORE_VERSION, slots, self.count)
+
+    # Puts key_id in the first free slot from its hash (linear probing)
+    def insert(self, key_id, record):
+        mask = self.slots - 1
+        i = IndexHash(key_id) & mask
+        while INDEX_SLOT.unpack_from(self.index, INDEX_HEADER.size + i*INDEX_SLOT.size)[1] != 0:
+            i = (i + 1) & mask
+        INDEX_SLOT.pack_into(self.index, INDEX_HEADER.size + i*INDEX_SLOT.size, key_id, record + 1)
+
+    # Writes the mappings to disk
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    # Trims the unused capacity and closes the files. Views handed out must not be used afterwards.
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        data, index = self.data, self.index
+        self.data = self.index = None
+        for m in (data, index):
+            try:
+                m.close()
+            except BufferError:     # a view is still exported, the mapping closes when it is freed
+                pass
+        self.file.truncate(KEYSTORE_HEADER.size + self.count*self.record_size)
+        self.file.close()
+
+# Hash of a key ID for the index. Key IDs may be chosen by the caller, so they are hashed rather
+# than used directly.
+def IndexHash(key_id):
+    return int.from_bytes(hashlib.blake2b(key_id, digest_size=8).digest(), "little")
+
+# Process pool for bulk key generation, encryption and decryption. The work is split into
+# contiguous chunks that each worker runs through the batched API, and inputs and outputs cross
+# process boundaries as joined byte strings. Results come back in input order.
+
+# Prepares the worker: loads the NTT tables and puts the given public keys in pk_cache, so the
+# first chunks do not pay for them
+def PoolWorkerInit(pks, params=NewHope1024):
+    GetNTTTables(params.n, params.root, params.q)
+    pk_cache.get_many(pks, params)
+
+# Splits a joined byte string into items of the given size
+def SplitBytes(blob, size):
+    return [blob[i:i+size] for i in range(0, len(blob), size)]
+
+# Worker task: generates a key pair for every 32-byte seed
+def PoolGenerate(seeds, params):
+    pks, sks = PKEGenBatch(len(seeds)//32, SplitBytes(seeds, 32), params)
+    return b"".join(pks), b"".join(sks)
+
+# Worker task: encrypts every 32-byte message to pk with the matching coin
+def PoolEncrypt(pk, msgs, coins, params):
+    msgs = SplitBytes(msgs, 32)
+    return b"".join(EncryptBatch([pk]*len(msgs), msgs, SplitBytes(coins, 32), params))
+
+# Worker task: encrypts every message to the matching public key with the matching coin
+def PoolEncryptBatch(pks, msgs, coins, params):
+    return b"".join(EncryptBatch(SplitBytes(pks, params.pk_bytes), SplitBytes(msgs, 32),
+                                 SplitBytes(coins, 32), params))
+
+# Worker task: decrypts every ciphertext with the matching secret key
+def PoolDecryptBatch(cs, sks, params):
+    ms = DecryptBatch(SplitBytes(cs, params.ct_bytes), SplitBytes(sks, params.sk_bytes), params)
+    return b"".join(bytes(m) for m in ms)
+
+# Worker task: decrypts every ciphertext with sk
+def PoolDecrypt(cs, sk, params):
+    cs = SplitBytes(cs, params.ct_bytes)
+    sk = PrepareSecretKey(sk)
+    return b"".join(bytes(m) for m in DecryptBatch(cs, [sk]*len(cs), params))
+
+class KeyPool:
+
+    # workers defaults to the number of CPUs. pks are public keys to prepare in every worker.
+    def __init__(self, workers=None, pks=(), params=NewHope1024):
+        self.workers = workers or os.cpu_count() or 1
+        self.params = params
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=PoolWorkerInit,
+                                            initargs=([bytes(pk) for pk in pks], params))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    # Returns the (start, end) bounds of the chunks n items are split into, a few per worker so
+    # that slower workers do not hold up the rest
+    def chunks(self, n):
+        size = max(1, -(-n // (4*self.workers)))
+        return [(i, min(i + size, n)) for i in range(0, n, size)]
+
+    # Generates n key pairs and returns the lists of public and secret keys. The 32-byte seeds are
+    # random unless they are given.
+    def generate(self, n, seeds=None):
+        if seeds is None:
+            seeds = [os.urandom(32) for _ in range(n)]
+        jobs = [b"".join(seeds[i:j]) for (i, j) in self.chunks(n)]
+        pks = []
+        sks = []
+        for (pk, sk) in self.executor.map(PoolGenerate, jobs, [self.params]*len(jobs)):
+            pks += SplitBytes(pk, self.params.pk_bytes)
+            sks += SplitBytes(sk, self.params.sk_bytes)
+        return pks, sks
+
+    # Encrypts every message to pk with the matching coin and returns the list of ciphertexts
+    def encrypt_many(self, pk, msgs, coins):
+        pk = bytes(AsBuffer(pk))
+        bounds = self.chunks(len(msgs))
+        jobs = self.executor.map(PoolEncrypt, [pk]*len(bounds),
+                                 [b"".join(bytes(m) for m in msgs[i:j]) for (i, j) in bounds],
+                                 [b"".join(coins[i:j]) for (i, j) in bounds],
+                                 [self.params]*len(bounds))
+        cs = []
+        for blob in jobs:
+            cs += SplitBytes(blob, self.params.ct_bytes)
+        return cs
+
+    # Decrypts every ciphertext with sk and returns the list of messages
+    def decrypt_many(self, cs, sk):
+        sk = bytes(AsBuffer(sk))
+        bounds = self.chunks(len(cs))
+        jobs = self.executor.map(PoolDecrypt, [b"".join(cs[i:j]) for (i, j) in bounds],
+                                 [sk]*len(bounds), [self.params]*len(bounds))
+        ms = []
+        for blob in jobs:
+            ms += [list(m) for m in SplitBytes(blob, 32)]
+        return ms
+
+# Raises ValueError unless every (value, size, name) has the given length in bytes
+def CheckLengths(items):
+    for (value, size, name) in items:
+        if len(value) != size:
+            raise ValueError("{} is {} bytes, not {}".format(name, len(value), size))
+
+# Asyncio front-end. Requests that arrive within window seconds of each other (up to max_batch
+# of them) are coalesced into one EncryptBatch or DecryptBatch call, which runs in a process pool
+# so the event loop is never blocked by the arithmetic.
+class KEMService:
+
+    def __init__(self, window=0.002, max_batch=256, workers=None, pks=(), params=NewHope1024):
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.params = params
+        self.executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                            initializer=PoolWorkerInit,
+                                            initargs=([bytes(pk) for pk in pks], params))
+        self.queues = {"encrypt": [], "decrypt": []}
+        self.timers = {}
+        self.running = set()
+
+    # Encrypts m to pk. The coin is random unless one is given. Requests are checked before they
+    # are queued, so that a malformed one cannot break the batch it would share with others.
+    async def encrypt(self, pk, m, coin=None):
+        if coin is None:
+            coin = os.urandom(32)
+        item = (bytes(AsBuffer(pk)), bytes(m), bytes(coin))
+        CheckLengths(zip(item, (self.params.pk_bytes, 32, 32), ("Public key", "Message", "Coin")))
+        return await self.submit("encrypt", item)
+
+    # Decrypts c with sk
+    async def decrypt(self, c, sk):
+        item = (bytes(AsBuffer(c)), bytes(AsBuffer(sk)))
+        CheckLengths(zip(item, (self.params.ct_bytes, self.params.sk_bytes),
+                         ("Ciphertext", "Secret key")))
+        return await self.submit("decrypt", item)
+
+    # Queues a request and waits for the batch it ends up in
+    async def submit(self, kind, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self.queues[kind]
+        queue.append((item, future))
+        if len(queue) >= self.max_batch or self.window <= 0:
+            self.flush(kind)
+        elif len(queue) == 1:
+            self.timers[kind] = loop.call_later(self.window, self.flush, kind)
+        return await future
+
+    # Sends the queued requests of one kind to the pool as a single batch
+    def flush(self, kind):
+        timer = self.timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.queues[kind]
+        self.queues[kind] = []
+        if batch:
+            task = asyncio.ensure_future(self.run(kind, batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run(self, kind, batch):
+        loop = asyncio.get_running_loop()
+        columns = [b"".join(column) for column in zip(*[item for (item, future) in batch])]
+        try:
+            if kind == "encrypt":
+                blob = await loop.run_in_executor(self.executor, PoolEncryptBatch, *columns,
+                                                  self.params)
+                results = SplitBytes(blob, self.params.ct_bytes)
+            else:
+                blob = await loop.run_in_executor(self.executor, PoolDecryptBatch, *columns,
+                                                  self.params)
+                results = [list(m) for m in SplitBytes(blob, 32)]
+        except Exception as e:
+            for (item, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for ((item, future), result) in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        if len(results) != len(batch):
+            error = RuntimeError("Batch of {} requests returned {} results".format(len(batch),
+                                                                                   len(results)))
+            for (item, future) in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+    # Flushes the pending requests, waits for them and shuts the pool down
+    async def close(self):
+        for kind in list(self.queues):
+            self.flush(kind)
+        if self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+        self.executor.shutdown()
+
+# Services used by EncryptAsync and DecryptAsync, one per parameter set, started on first use
+default_services = {}
+
+def DefaultKEMService(params=NewHope1024):
+    service = default_services.get(params.name)
+    if service is None:
+        service = default_services[params.name] = KEMService(params=params)
+    return service
+
+# Encrypts m to pk without blocking the event loop, coalescing concurrent calls into batches
+async def EncryptAsync(pk, m, coin=None, params=NewHope1024):
+    return await DefaultKEMService(params).encrypt(pk, m, coin)
+
+# Decrypts c with sk without blocking the event loop, coalescing concurrent calls into batches
+async def DecryptAsync(c, sk, params=NewHope1024):
+    return await DefaultKEMService(params).decrypt(c, sk)
+
+encrypt_async = EncryptAsync
+decrypt_async = DecryptAsync
+
+# Demo KEM server protocol. Every request and response is a 4-byte big-endian length followed by
+# that many bytes. A request starts with an operation byte:
+#   b"K"             returns the server's public key
+#   b"E" + m         returns the encryption of the 32-byte message m to the server's public key
+#   b"D" + c         returns the 32-byte decryption of ciphertext c with the server's secret key
+async def ReadFrame(reader):
+    size = struct.unpack(">I", await reader.readexactly(4))[0]
+    return await reader.readexactly(size)
+
+def WriteFrame(writer, payload):
+    writer.write(struct.pack(">I", len(payload)) + payload)
+
+# Runs the demo server on a TCP port, or on a Unix socket if a path is given
+async def Serve(host="127.0.0.1", port=8765, path=None, window=0.002, max_batch=256, workers=None,
+                params=NewHope1024):
+    pk, sk = PKEGen(params=params)
+    service = KEMService(window, max_batch, workers, pks=[pk], params=params)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await ReadFrame(reader)
+                op, payload = request[0:1], request[1:]
+                if op == b"K":
+                    WriteFrame(writer, pk)
+                elif op == b"E":
+                    WriteFrame(writer, await service.encrypt(pk, payload))
+                elif op == b"D":
+                    WriteFrame(writer, bytes(await service.decrypt(payload, sk)))
+                else:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    if path is not None:
+        server = await asyncio.start_unix_server(handle, path=path)
+    else:
+        server = await asyncio.start_server(handle, host, port)
+    print("Serving {} on {} (window {:.1f} ms, max batch {})".format(
+        params.name, path or "{}:{}".format(host, port), window*1000, max_batch))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+# Load generator for the demo server: each client connection sends its share of requests one after
+# another, alternating decryptions and encryptions. Prints the throughput and latency percentiles.
+async def LoadGen(host="127.0.0.1", port=8765, path=None, clients=64, requests=4000,
+                  params=NewHope1024):
+    async def connect():
+        if path is not None:
+            return await asyncio.open_unix_connection(path)
+        return await asyncio.open_connection(host, port)
+
+    reader, writer = await connect()
+    WriteFrame(writer, b"K")
+    pk = await ReadFrame(reader)
+    writer.close()
+
+    msgs = [os.urandom(32) for _ in range(requests)]
+    cs = EncryptBatch([pk]*requests, msgs, [os.urandom(32) for _ in range(requests)], params)
+    latencies = []
+    failures = 0
+
+    async def client(indices):
+        nonlocal failures
+        reader, writer = await connect()
+        for i in indices:
+            request = b"D" + cs[i] if i % 2 == 0 else b"E" + msgs[i]
+            start = time.perf_counter()
+            WriteFrame(writer, request)
+            await writer.drain()
+            response = await ReadFrame(reader)
+            latencies.append(time.perf_counter() - start)
+            if i % 2 == 0 and response != msgs[i]:
+                failures += 1
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(range(k, requests, clients)) for k in range(clients)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print("{} requests from {} clients in {:.2f} s: {:.1f} requests/s".format(
+        requests, clients, elapsed, requests/elapsed))
+    print("Latency p50 {:.2f} ms  p95 {:.2f} ms  p99 {:.2f} ms  max {:.2f} ms".format(
+        Percentile(latencies, 50)*1000, Percentile(latencies, 95)*1000,
+        Percentile(latencies, 99)*1000, latencies[-1]*1000))
+    print("Decryption failures: {}".format(failures))
+
+# Monte Carlo estimate of the decryption failure rate. Every trial generates a key pair, encrypts
+# a message and decrypts it, all from 96 bytes derived from the run seed, so a run is reproducible
+# and can be split into chunks that run on any core in any order. The results stream to a file of
+# JSON lines: a header with the configuration, then one line per finished chunk with its trials,
+# failures, bit errors and noise histogram. The file is the checkpoint: a run given an existing
+# file checks that it has the same configuration and continues after its last complete chunk.
+
+# Returns the keyseed, message and coin of every trial in a chunk
+def FailureChunkSeeds(seed, index, trials, params):
+    z = hashlib.shake_256(b"NewHope failure rate" + params.name.encode() + bytes(seed)
+                          + index.to_bytes(8, "little")).digest(96*trials)
+    return [(z[96*i:96*i+32], z[96*i+32:96*i+64], z[96*i+64:96*i+96]) for i in range(trials)]
+
+# Worker task: runs the trials of one chunk. Returns the number of failed messages and the number
+# of wrong message bits, both counted on the output of DecryptBatch, and the histogram of the noise
+# in v_sub = v_prime - INTT(u_hat*s_hat), that is v_sub minus the encoded message, centered in
+# [-q/2, q/2). Decryption fuses the steps and never materializes v_sub, so the histogram recomputes
+# it unfused. The histogram pools every coefficient position of every trial.
+def FailureChunk(seed, index, trials, params):
+    triples = FailureChunkSeeds(seed, index, trials, params)
+    keyseeds = [t[0] for t in triples]
+    msgs = [t[1] for t in triples]
+    coins = [t[2] for t in triples]
+    pks, sks = PKEGenBatch(trials, keyseeds, params)
+    cs = EncryptBatch(pks, msgs, coins, params)
+    decoded = DecryptBatch(cs, sks, params)
+    q = params.q
+
+    if BACKEND == "numpy":
+        c = np.frombuffer(b"".join(cs), dtype=np.uint8).reshape(trials, params.ct_bytes)
+        u_hat = DecodePolyBatch(c[:, 0:params.poly_bytes])
+        v_prime = DecompressBatch(c[:, params.poly_bytes:])
+        v_sub = PolySubtract(v_prime, INTT(Poly_mul(u_hat, DecodePolyBatch(sks)), params.root, q))
+        noise = (v_sub.astype(np.int32) - EncodeMsgBatch(msgs, params) + q//2) % q
+        counts = np.bincount(noise.ravel(), minlength=q)
+        histogram = {int(x) - q//2: int(counts[x]) for x in np.flatnonzero(counts)}
+    else:
+        histogram = Counter()
+        for (c, sk, m) in zip(cs, sks, msgs):
+            u_hat, h = DecodeC(c, params)
+            product = INTT(Poly_mul(u_hat, DecodePoly(sk)), params.root, q)
+            v_sub = PolySubtract(Decompress(h), product)
+            histogram.update((x - y + q//2) % q - q//2 for (x, y) in zip(v_sub, EncodeMsg(m, params)))
+        histogram = dict(histogram)
+
+    failures = 0
+    bit_errors = 0
+    for (m, m_prime) in zip(msgs, decoded):
+        errors = sum(POPCOUNT[x ^ y] for (x, y) in zip(m, m_prime))
+        failures += errors > 0
+        bit_errors += errors
+    return failures, bit_errors, histogram
+
+# Returns the Wilson score interval of a proportion of k in n at confidence level z (1.96 for 95%)
+def WilsonInterval(k, n, z=1.96):
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    center = (p + z*z/(2*n)) / (1 + z*z/n)
+    half = z*math.sqrt(p*(1 - p)/n + z*z/(4*n*n)) / (1 + z*z/n)
+    lower = 0.0 if k == 0 else max(0.0, center - half)
+    upper = 1.0 if k == n else min(1.0, center + half)
+    return lower, upper
+
+# Reads the chunks already in a results file. Returns the list of chunk records, after dropping a
+# last line cut short by an interrupted write. Raises ValueError if the configuration differs.
+def ReadFailureResults(path, config):
+    chunks = []
+    good = 0
+    with open(path, "rb+") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            good += len(line)
+            if "config" in record:
+                if record["config"] != config:
+                    raise ValueError("{} was written with {}".format(path, record["config"]))
+            else:
+                chunks.append(record)
+        f.truncate(good)
+    return chunks
+
+# Runs trials decryption trials (rounded up to whole chunks) on workers processes and returns the
+# summary. seed is any bytes. With a path, the chunk results are appended to it as they finish and
+# a run with the same path and configuration resumes where it stopped.
+def FailureRate(trials, seed=b"", params=NewHope1024, workers=None, chunk=1000, path=None,
+                progress=None):
+    seed = bytes(seed)
+    config = {"seed": seed.hex(), "params": params.name, "chunk": chunk}
+    chunks = []
+    if path is not None and os.path.exists(path) and os.path.getsize(path) > 0:
+        chunks = ReadFailureResults(path, config)
+    out = None
+    if path is not None:
+        out = open(path, "a")
+        if not chunks and out.tell() == 0:
+            out.write(json.dumps({"config": config}) + "\n")
+            out.flush()
+
+    done = len(chunks)
+    todo = range(done, -(-trials // chunk))
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    new_trials = 0
+    try:
+        if workers == 1:
+            results = (FailureChunk(seed, i, chunk, params) for i in todo)
+            for (i, result) in zip(todo, results):
+                chunks.append(RecordFailureChunk(out, i, chunk, result))
+                new_trials += chunk
+                if progress:
+                    progress(chunks, time.perf_counter() - start, new_trials)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=PoolWorkerInit,
+                                     initargs=([], params)) as executor:
+                # A few chunks per worker are in flight, and they are recorded in order
+                pending = deque()
+                it = iter(todo)
+                for i in it:
+                    pending.append((i, executor.submit(FailureChunk, seed, i, chunk, params)))
+                    if len(pending) >= 4*workers:
+                        break
+                while pending:
+                    (i, future) = pending.popleft()
+                    chunks.append(RecordFailureChunk(out, i, chunk, future.result()))
+                    new_trials += chunk
+                    for j in it:
+                        pending.append((j, executor.submit(FailureChunk, seed, j, chunk, params)))
+                        break
+                    if progress:
+                        progress(chunks, time.perf_counter() - start, new_trials)
+    finally:
+        if out is not None:
+            out.close()
+    return SummarizeFailures(chunks, time.perf_counter() - start, new_trials, params)
+
+# Writes one chunk result as a line of the results file and returns it as a record
+def RecordFailureChunk(out, index, trials, result):
+    failures, bit_errors, histogram = result
+    record = {"chunk": index, "trials": trials, "failures": failures, "bit_errors": bit_errors,
+              "noise": {str(x): k for (x, k) in sorted(histogram.items())}}
+    if out is not None:
+        out.write(json.dumps(record, separators=(",", ":")) + "\n")
+        out.flush()
+    return record
+
+# Combines chunk records into the summary reported by FailureRate
+def SummarizeFailures(chunks, elapsed, new_trials, params):
+    trials = sum(record["trials"] for record in chunks)
+    failures = sum(record["failures"] for record in chunks)
+    bit_errors = sum(record["bit_errors"] for record in chunks)
+    noise = Counter()
+    for record in chunks:
+        noise.update({int(x): k for (x, k) in record["noise"].items()})
+    count = sum(noise.values())
+    mean = sum(x*k for (x, k) in noise.items()) / count if count else 0.0
+    var = sum((x - mean)**2*k for (x, k) in noise.items()) / count if count else 0.0
+    return {"params": params.name,
+            "trials": trials,
+            "failures": failures,
+            "failure_rate": failures/trials if trials else 0.0,
+            "failure_rate_95": WilsonInterval(failures, trials),
+            "bit_errors": bit_errors,
+            "bit_error_rate": bit_errors/(256*trials) if trials else 0.0,
+            "bit_error_rate_95": WilsonInterval(bit_errors, 256*trials),
+            "noise_mean": mean,
+            "noise_std": math.sqrt(var),
+            "noise_min": min(noise) if noise else 0,
+            "noise_max": max(noise) if noise else 0,
+            "noise_histogram": dict(sorted(noise.items())),
+            "seconds": elapsed,
+            "trials_per_sec": new_trials/elapsed if elapsed > 0 else 0.0}
+
+# Prints a FailureRate summary, with the noise histogram in bins of width q/64 and the fraction of
+# coefficients beyond q/8 and q/4 in magnitude
+def PrintFailureRate(summary, bins=16):
+    q = NEWHOPE_Q
+    print("{}: {} trials, {} failures, {} bit errors ({:.1f} trials/s this run)".format(
+        summary["params"], summary["trials"], summary["failures"], summary["bit_errors"],
+        summary["trials_per_sec"]))
+    print("Failure rate   {:.3e}  95% CI [{:.3e}, {:.3e}]".format(
+        summary["failure_rate"], *summary["failure_rate_95"]))
+    print("Bit error rate {:.3e}  95% CI [{:.3e}, {:.3e}]".format(
+        summary["bit_error_rate"], *summary["bit_error_rate_95"]))
+    noise = summary["noise_histogram"]
+    total = sum(noise.values()) or 1
+    print("Noise in v_sub: mean {:.2f}  std {:.2f}  min {}  max {}".format(
+        summary["noise_mean"], summary["noise_std"], summary["noise_min"], summary["noise_max"]))
+    for limit in (q//8, q//4):
+        beyond = sum(k for (x, k) in noise.items() if abs(x) > limit)
+        print("  |noise| > {:5d}: {:.3e} of coefficients".format(limit, beyond/total))
+    width = q//64
+    binned = Counter()
+    for (x, k) in noise.items():
+        binned[(x + width//2)//width] += k
+    peak = max(binned.values()) if binned else 1
+    for b in sorted(binned):
+        if binned[b]/total >= 1e-6:
+            print("  {:6d} {:10.3e} {}".format(b*width, binned[b]/total, "#"*int(50*binned[b]/peak)))
+
+# Instrumentation of the pipeline stages. It is off by default and then costs nothing:
+# EnableInstrumentation rebinds the functions listed in INSTRUMENTED_STAGES to wrappers that count
+# and time every call, and DisableInstrumentation puts the original functions back. A stage's time
+# includes the stages it calls, e.g. the "pke" time of Encrypt includes its NTTs.
+INSTRUMENTED_STAGES = {
+    "shake": ["GenA", "GenABatch"],
+    "sample": ["Sample", "SampleBatch"],
+    "ntt": ["NTT", "INTT", "INTTAddCompress", "INTTSubtractDecode"],
+    "pointwise": ["Poly_mul", "Poly_add", "PolySubtract", "PolyMulAdd"],
+    "codec": ["EncodePoly", "DecodePoly", "EncodeMsg", "DecodeMsg", "Compress", "Decompress",
+              "EncodePolyBatch", "DecodePolyBatch", "EncodeMsgBatch", "DecodeMsgBatch",
+              "CompressBatch", "DecompressBatch"],
+    "pke": ["PKEGen", "Encrypt", "Decrypt", "PKEGenBatch", "EncryptBatch", "DecryptBatch"],
+}
+
+# Number of latency histogram buckets. Bucket k counts calls that took less than 2^k microseconds.
+HISTOGRAM_BUCKETS = 32
+
+class Instruments:
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.originals = {}
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.seconds = {}
+            self.histograms = {}
+            self.hashed_bytes = 0
+
+    # Counts bytes squeezed from SHAKE
+    def hashed(self, nbytes):
+        with self.lock:
+            self.hashed_bytes += nbytes
+
+    # Records one call of the named function and passes it on to the hooks. A hook that raises is
+    # logged and skipped, so that a failing exporter never breaks the instrumented call.
+    def record(self, stage, name, seconds):
+        bucket = min(int(seconds*1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0]*HISTOGRAM_BUCKETS
+            histogram[bucket] += 1
+        for hook in self.hooks:
+            try:
+                hook(stage, name, seconds)
+            except Exception:
+                logging.exception("Instrumentation hook {!r} failed".format(hook))
+
+    # Returns the counters as a dict: per function, per stage, and the number of bytes hashed
+    def snapshot(self):
+        stage_of = {name: stage for (stage, names) in INSTRUMENTED_STAGES.items() for name in names}
+        with self.lock:
+            functions = {}
+            stages = {}
+            for (name, calls) in self.calls.items():
+                histogram = self.histograms[name]
+                functions[name] = {"stage": stage_of[name], "calls": calls,
+                                   "total_s": self.seconds[name],
+                                   "histogram_us": {str(1 << k): n for (k, n) in enumerate(histogram) if n}}
+                stage = stages.setdefault(stage_of[name], {"calls": 0, "total_s": 0.0})
+                stage["calls"] += calls
+                stage["total_s"] += self.seconds[name]
+            return {"enabled": self.enabled, "hashed_bytes": self.hashed_bytes,
+                    "stages": stages, "functions": functions}
+
+instruments = Instruments()
+
+# Returns a wrapper of fn that records the time of every call
+def Instrumented(stage, name, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            instruments.record(stage, name, time.perf_counter() - start)
+    wrapper.__name__ = name
+    wrapper.__wrapped__ = fn
+    return wrapper
+
+# Starts counting and timing the instrumented functions
+def EnableInstrumentation():
+    if instruments.enabled:
+        return
+    module = globals()
+    for (stage, names) in INSTRUMENTED_STAGES.items():
+        for name in names:
+            instruments.originals[name] = module[name]
+            module[name] = Instrumented(stage, name, module[name])
+    instruments.enabled = True
+
+# Stops instrumenting and restores the original functions. The counters are kept.
+def DisableInstrumentation():
+    if not instruments.enabled:
+        return
+    globals().update(instruments.originals)
+    instruments.originals.clear()
+    instruments.enabled = False
+
+# Adds a function called as hook(stage, name, seconds) after every instrumented call, for example
+# to feed a metrics exporter
+def AddInstrumentationHook(hook):
+    instruments.hooks.append(hook)
+
+def RemoveInstrumentationHook(hook):
+    instruments.hooks.remove(hook)
+
+# Returns the instrumentation counters as a dict
+def InstrumentationSnapshot():
+    return instruments.snapshot()
+
+# Prints the per-stage and per-function counters
+def PrintInstrumentation(snapshot):
+    print("Bytes hashed: {}".format(snapshot["hashed_bytes"]))
+    for (stage, s) in snapshot["stages"].items():
+        print("{:<10}{:>8} calls {:>10.3f} ms".format(stage, s["calls"], s["total_s"]*1000))
+    for (name, f) in snapshot["functions"].items():
+        print("  {:<16}{:>8} calls {:>10.3f} ms".format(name, f["calls"], f["total_s"]*1000))
+
+# Checks the fast NTT and INTT against the naive transform on random vectors. The fast NTT is the
+# naive transform of the psi-scaled input, returned in bit-reversed order, and the fast INTT is
+# the naive inverse transform of a bit-reversed input, scaled by the powers of 1/psi.
+def CheckNTT(trials=2):
+    for params in PARAMETER_SETS.values():
+        n, root, q = params.n, params.root, params.q
+        psi = params.tables["psi"]
+        bits = n.bit_length() - 1
+        for _ in range(trials):
+            a = [random.randrange(q) for _ in range(n)]
+            scaled = [(a[j]*pow(psi, j, q)) % q for j in range(n)]
+            expected = NTT_naive(scaled, root, q)
+            a_hat = ToList(NTT(a, root, q))
+            if any(a_hat[bitrev(i, bits)] != expected[i] for i in range(n)):
+                return False
+            if ToList(INTT(a_hat, root, q)) != a:
+                return False
+            # INTT of a bit-reversed b_hat is the naive inverse transform, unscaled by psi
+            b_hat = [random.randrange(q) for _ in range(n)]
+            y = INTT_naive([b_hat[bitrev(i, bits)] for i in range(n)], root, q)
+            psi_inv = reciprocal(psi, q)
+            expected = [(y[j]*pow(psi_inv, j, q)) % q for j in range(n)]
+            if ToList(INTT(b_hat, root, q)) != expected:
+                return False
+    return True
+
+# Checks that the NumPy backend agrees with the pure-Python backend on random inputs
+def CheckBackend(trials=10):
+    if np is None:
+        return True
+    for _ in range(trials):
+        a = [random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+        b = [random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+        m = [random.randrange(256) for _ in range(32)]
+        pairs = [(Poly_mul_numpy(a, b), Poly_mul_python(a, b)),
+                 (Poly_add_numpy(a, b), Poly_add_python(a, b)),
+                 (PolySubtract_numpy(a, b), PolySubtract_python(a, b)),
+                 (NTT_numpy(a), NTT_python(a)),
+                 (INTT_numpy(a), INTT_python(a)),
+                 (EncodeMsg_numpy(m), EncodeMsg_python(m)),
+                 (DecodeMsg_numpy(a), DecodeMsg_python(a)),
+                 (EncodePoly_numpy(a), EncodePoly_python(a)),
+                 (DecodePoly_numpy(EncodePoly_python(a)), a)]
+        if any(ToList(x) != y for (x, y) in pairs):
+            return False
+    return True
+
+# Known answer for GenA, from poly_uniform of the NewHope reference implementation (ref/poly.c of
+# the NIST submission) for the public seed 00 01 02 ... 1f, with the coefficients reduced mod q:
+# the first and last 16 coefficients, and the SHA-256 of all of them as little-endian 16-bit values
+GENA_KAT_SEED = bytes(range(32))
+GENA_KAT_HEAD = [2142, 11503, 5032, 4258, 11993, 5274, 539, 7439, 2199, 2998, 247, 1130, 10052,
+                 10084, 4127, 8586]
+GENA_KAT_TAIL = [4439, 2943, 2444, 458, 11737, 7076, 7997, 9210, 9007, 2427, 10949, 10304, 1948,
+                 7432, 8152, 11661]
+GENA_KAT_SHA256 = "19010fa0ab856cfc6ad746d2e5867c5db42ab661b3ae1f2192f271fdcdd8c4c4"
+
+# Checks GenA and GenABatch against the known answer, and that XOFReader continues the SHAKE output
+# across reads of any size
+def CheckGenA():
+    sizes = [SQUEEZE_BLOCK_SIZE, 1, SQUEEZE_BLOCK_SIZE, 500, 7, 3*SQUEEZE_BLOCK_SIZE]
+    digest = hashlib.shake_128(b"GenA").digest(sum(sizes))
+    xof = XOFReader(hashlib.shake_128(b"GenA"))
+    if b"".join(bytes(xof.read(size)) for size in sizes) != digest:
+        return False
+    a_hat = ToList(GenA(GENA_KAT_SEED))
+    if a_hat[:16] != GENA_KAT_HEAD or a_hat[-16:] != GENA_KAT_TAIL:
+        return False
+    if hashlib.sha256(struct.pack("<{}H".format(NEWHOPE_N), *a_hat)).hexdigest() != GENA_KAT_SHA256:
+        return False
+    return BACKEND != "numpy" or GenABatch([GENA_KAT_SEED]).tolist() == [a_hat]
+
+# Checks Sample against the original sampler
+def CheckSample(trials=4):
+    for nonce in range(trials):
+        seed = os.urandom(32)
+        if ToList(Sample(seed, nonce)) != Sample_naive(seed, nonce):
+            return False
+    return True
+
+# Checks that the batched API returns the same keys, ciphertexts and messages as the single-item
+# functions, with fixed seeds and coins
+def CheckBatch(n=4):
+    seeds = [bytes([i])*32 for i in range(n)]
+    coins = [bytes([i+n])*32 for i in range(n)]
+    msgs = [[random.randrange(256) for _ in range(32)] for _ in range(n)]
+    pks, sks = PKEGenBatch(n, seeds)
+    keys = [PKEGen(seed) for seed in seeds]
+    if pks != [pk for (pk, sk) in keys] or sks != [sk for (pk, sk) in keys]:
+        return False
+    cs = EncryptBatch(pks, msgs, coins)
+    if cs != [Encrypt(pk, m, coin) for (pk, m, coin) in zip(pks, msgs, coins)]:
+        return False
+    if DecryptBatch(cs, sks) != [Decrypt(c, sk) for (c, sk) in zip(cs, sks)]:
+        return False
+    # Empty batches give empty lists, and lists of different lengths are refused
+    if PKEGenBatch(0) != ([], []) or EncryptBatch([], [], []) != [] or DecryptBatch([], []) != []:
+        return False
+    if PreparePublicKeys([]) != []:
+        return False
+    for (f, args) in [(EncryptBatch, (pks, msgs[:-1], coins)), (EncryptBatch, (pks, msgs, coins[:1])),
+                      (DecryptBatch, (cs, sks[:-1])), (PKEGenBatch, (n, seeds[:-1]))]:
+        try:
+            f(*args)
+            return False
+        except ValueError:
+            pass
+    return True
+
+# Checks that encrypting to a prepared or cached public key gives the same ciphertext
+def CheckPublicKeyCache():
+    pk, sk = PKEGen(bytes(32))
+    m = [random.randrange(256) for _ in range(32)]
+    coin = os.urandom(32)
+    cache = PublicKeyCache(maxsize=1)
+    c = Encrypt(pk, m, coin)
+    if Encrypt(PreparePublicKey(pk), m, coin) != c:
+        return False
+    cache.get(pk)
+    cache.get(pk)
+    cache.get(PKEGen(bytes([1])*32)[0])
+    stats = cache.stats()
+    if (stats["hits"], stats["misses"], stats["evictions"], stats["size"]) != (1, 2, 1, 1):
+        return False
+    # A key of another parameter set is refused, prepared or not
+    pk512 = PKEGen(bytes(32), NewHope512)[0]
+    prepared512 = PreparePublicKey(pk512, NewHope512)
+    for (f, args) in [(Encrypt, (prepared512, m, coin)), (Encrypt, (pk512, m, coin)),
+                      (EncryptBatch, ([prepared512], [m], [coin])), (cache.get, (prepared512,)),
+                      (PreparePublicKey, (pk512,))]:
+        try:
+            f(*args)
+            return False
+        except ValueError:
+            pass
+    return cache.get(prepared512, NewHope512) is prepared512
+
+# Checks that decrypting with a prepared secret key gives the same message
+def CheckPreparedSecretKey():
+    pk, sk = PKEGen(bytes(32))
+    c = Encrypt(pk, [random.randrange(256) for _ in range(32)], os.urandom(32))
+    prepared = PrepareSecretKey(sk)
+    m = Decrypt(c, sk)
+    return Decrypt(c, prepared) == m and DecryptBatch([c, c], [prepared, sk]) == [m, m]
+
+# Checks Compress and Decompress of both backends and the batched versions against the original
+# scalar codec, and the round-trip properties: Compress(Decompress(h)) == h for every h, and
+# Decompress(Compress(v)) is within q/16 of v
+def CheckCompress(trials=20):
+    backends = [(Compress_python, Decompress_python)]
+    if np is not None:
+        backends.append((Compress_numpy, Decompress_numpy))
+    for _ in range(trials):
+        v = [random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+        h = os.urandom(NEWHOPE_3N_8)
+        for (compress, decompress) in backends:
+            if compress(v) != Compress_naive(v) or ToList(decompress(h)) != ToList(Decompress_naive(h)):
+                return False
+            if compress(decompress(h)) != h:
+                return False
+            d = [(x - y) % NEWHOPE_Q for (x, y) in zip(ToList(decompress(compress(v))), v)]
+            if any(min(x, NEWHOPE_Q - x) > NEWHOPE_Q//16 + 1 for x in d):
+                return False
+    if np is not None:
+        hs = [os.urandom(NEWHOPE_3N_8) for _ in range(3)]
+        r = DecompressBatch(np.frombuffer(b"".join(hs), dtype=np.uint8).reshape(3, -1))
+        if [row.tobytes() for row in CompressBatch(r)] != hs:
+            return False
+    return True
+
+# Checks the fused kernels of both backends against the unfused chains of the pure-Python
+# functions, on random polynomials and on the largest coefficients, which bound the lazy reductions
+def CheckFused(trials=4):
+    backends = [(PolyMulAdd_python, INTTAddCompress_python, INTTSubtractDecode_python)]
+    if np is not None:
+        backends.append((PolyMulAdd_numpy, INTTAddCompress_numpy, INTTSubtractDecode_numpy))
+    for trial in range(trials + 1):
+        if trial < trials:
+            a, b, e, v = ([random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)] for _ in range(4))
+        else:
+            a = b = e = v = [NEWHOPE_Q - 1]*NEWHOPE_N
+        product = INTT_python(Poly_mul_python(a, b))
+        mul_add = Poly_add_python(Poly_mul_python(a, b), e)
+        compressed = bytes(Compress(Poly_add_python(Poly_add_python(product, e), v)))
+        decoded = DecodeMsg_python(PolySubtract_python(v, product))
+        for (mul_add_fn, compress_fn, decode_fn) in backends:
+            if (ToList(mul_add_fn(a, b, e)) != mul_add
+                    or bytes(compress_fn(a, b, e, v)) != compressed
+                    or ToList(decode_fn(a, b, v)) != decoded):
+                return False
+    if np is not None:
+        a, b, e, v = (np.array([[random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+                                for _ in range(3)], dtype=np.uint16) for _ in range(4))
+        h = INTTAddCompress_numpy(a, b, e, v)
+        m = INTTSubtractDecode_numpy(a, b, v)
+        for k in range(3):
+            rows = [ToList(x[k]) for x in (a, b, e, v)]
+            if (bytes(h[k]) != INTTAddCompress_python(*rows)
+                    or m[k].tolist() != INTTSubtractDecode_python(rows[0], rows[1], rows[3])):
+                return False
+    return True
+
+# Checks that streams of awkward lengths round-trip and that modified or truncated streams are
+# rejected
+def CheckStream():
+    pk, sk = PKEGen(bytes(32))
+    for size in (0, 1, 1000, 4096, 4097, 3*4096):
+        data = os.urandom(size)
+        out = io.BytesIO()
+        EncryptStream(pk, io.BytesIO(data), out, chunk_size=4096)
+        stream = out.getvalue()
+        back = io.BytesIO()
+        if DecryptStream(sk, io.BytesIO(stream), back) != size or back.getvalue() != data:
+            return False
+
+    tampered = bytearray(stream)
+    tampered[-STREAM_TAG_BYTES - 1] ^= 1
+    # A chunk size changed in the header, and chunks claiming to be longer than the chunk size
+    # (which must be refused before they are read)
+    header_size = len(STREAM_MAGIC) + NewHope1024.ct_bytes + STREAM_NONCE_BYTES + STREAM_FRAME.size
+    header, frame = stream[:header_size - STREAM_FRAME.size], STREAM_FRAME.pack(4097)
+    resized = header + frame + stream[header_size:]
+    oversized = stream[:header_size] + STREAM_FRAME.pack(STREAM_LAST | 4097) + bytes(4097 + STREAM_TAG_BYTES)
+    huge = header + STREAM_FRAME.pack(STREAM_MAX_CHUNK_SIZE + 1)
+    forged = stream[:header_size] + STREAM_FRAME.pack(STREAM_LAST - 1)
+    for bad in (bytes(tampered), stream[:-1], stream[:-(4096 + STREAM_TAG_BYTES + 4)], stream + b"x",
+                resized, oversized, huge, forged):
+        try:
+            DecryptStream(sk, io.BytesIO(bad), io.BytesIO())
+            return False
+        except ValueError:
+            pass
+    try:
+        EncryptStream(pk, io.BytesIO(b""), io.BytesIO(), chunk_size=STREAM_MAX_CHUNK_SIZE + 1)
+        return False
+    except ValueError:
+        pass
+    return True
+
+# Checks NewHope512: the sizes of keys and ciphertexts, that messages round-trip, that the batched
+# API and the NumPy backend agree with the single-item pure-Python functions, and that streams work
+def CheckParameterSets(n=4):
+    params = NewHope512
+    seeds = [os.urandom(32) for _ in range(n)]
+    msgs = [os.urandom(32) for _ in range(n)]
+    coins = [os.urandom(32) for _ in range(n)]
+    keys = [PKEGen(seed, params) for seed in seeds]
+    cs = [Encrypt(pk, m, coin, params) for ((pk, sk), m, coin) in zip(keys, msgs, coins)]
+    if any(len(pk) != params.pk_bytes or len(sk) != params.sk_bytes for (pk, sk) in keys):
+        return False
+    if any(len(c) != params.ct_bytes for c in cs):
+        return False
+    if [bytes(Decrypt(c, sk, params)) for (c, (pk, sk)) in zip(cs, keys)] != msgs:
+        return False
+
+    pks, sks = PKEGenBatch(n, seeds, params)
+    if list(zip(pks, sks)) != keys or EncryptBatch(pks, msgs, coins, params) != cs:
+        return False
+    if [bytes(m) for m in DecryptBatch(cs, sks, params)] != msgs:
+        return False
+
+    if np is not None:
+        a = [random.randrange(NEWHOPE_Q) for _ in range(params.n)]
+        b = [random.randrange(NEWHOPE_Q) for _ in range(params.n)]
+        pairs = [(NTT_numpy(a, params.root), NTT_python(a, params.root)),
+                 (INTT_numpy(a, params.root), INTT_python(a, params.root)),
+                 (EncodeMsg_numpy(msgs[0], params), EncodeMsg_python(msgs[0], params)),
+                 (DecodeMsg_numpy(a), DecodeMsg_python(a)),
+                 (INTTSubtractDecode_numpy(a, b, a, params.root),
+                  INTTSubtractDecode_python(a, b, a, params.root)),
+                 (list(INTTAddCompress_numpy(a, b, a, b, params.root)),
+                  list(INTTAddCompress_python(a, b, a, b, params.root)))]
+        if any(ToList(x) != y for (x, y) in pairs):
+            return False
+
+    pk, sk = keys[0]
+    out = io.BytesIO()
+    EncryptStream(pk, io.BytesIO(msgs[0]*100), out, params=params)
+    back = io.BytesIO()
+    DecryptStream(sk, io.BytesIO(out.getvalue()), back, params)
+    return back.getvalue() == msgs[0]*100
+
+# Checks that the key store keeps records and index across reopening, grows past its initial
+# capacity, hands out views that decrypt in place, rebuilds a missing index and rejects duplicate
+# IDs and mismatched parameter sets
+def CheckKeyStore():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "keys")
+        pks, sks = PKEGenBatch(4, params=NewHope512)
+        with KeyStore(path, NewHope512) as store:
+            store.extend(pks, sks)
+            pk, sk = pks[0], sks[0]
+            ids = [i.to_bytes(KEYSTORE_ID_BYTES, "big") for i in range(KEYSTORE_INITIAL_CAPACITY)]
+            store.extend([pk]*len(ids), [sk]*len(ids), ids)
+            try:
+                store.append(pk, sk, ids[5])
+                return False
+            except ValueError:
+                pass
+        os.remove(path + ".idx")
+        with KeyStore(path) as store:
+            if store.params is not NewHope512 or len(store) != 4 + len(ids):
+                return False
+            if store.find(ids[-1]) != 3 + len(ids) or store.find(ids[0]) != 4:
+                return False
+            for (i, (pk, sk)) in enumerate(zip(pks, sks)):
+                view_pk, view_sk = store.get(KeyID(pk))
+                if not isinstance(view_pk, memoryview) or view_pk != pk or view_sk != sk:
+                    return False
+                m = os.urandom(32)
+                c = Encrypt(view_pk, m, os.urandom(32), NewHope512)
+                if bytes(Decrypt(c, view_sk, NewHope512)) != m:
+                    return False
+                del view_pk, view_sk
+        try:
+            KeyStore(path, NewHope1024)
+            return False
+        except ValueError:
+            pass
+        # Files that are not stores, including ones shorter than the header, are refused
+        for content in (b"short", b"x"*1000):
+            other = os.path.join(tmp, "other")
+            with open(other, "wb") as f:
+                f.write(content)
+            try:
+                KeyStore(other)
+                return False
+            except ValueError:
+                pass
+    return True
+
+# Checks that the failure-rate harness is deterministic and that a run resumed from its results
+# file gives the same totals as an uninterrupted one
+def CheckFailureRate():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "results")
+        FailureRate(20, b"check", NewHope512, workers=1, chunk=10, path=path)
+        with open(path, "a") as f:
+            f.write('{"chunk": 2, "tri')       # an interrupted write
+        resumed = FailureRate(40, b"check", NewHope512, workers=1, chunk=10, path=path)
+        fresh = FailureRate(40, b"check", NewHope512, workers=1, chunk=10)
+        try:
+            FailureRate(40, b"other", NewHope512, workers=1, chunk=10, path=path)
+            return False
+        except ValueError:
+            pass
+    keys = ("trials", "failures", "bit_errors", "noise_histogram")
+    return (resumed["trials"] == 40 and resumed["noise_histogram"]
+            and all(resumed[key] == fresh[key] for key in keys))
+
+# Checks that KEMService answers every request of a coalesced batch, that malformed requests are
+# refused without affecting the others, and that a batch coming back short fails its requests
+# instead of leaving them waiting
+def CheckKEMService(n=4):
+    pk, sk = PKEGen(bytes(32))
+    msgs = [os.urandom(32) for _ in range(n)]
+    cs = [Encrypt(pk, m, os.urandom(32)) for m in msgs]
+
+    async def check():
+        service = KEMService(window=0.05, workers=1)
+        try:
+            async def refused(request):
+                try:
+                    await request
+                    return False
+                except ValueError:
+                    return True
+            results = await asyncio.gather(
+                *[service.encrypt(pk, m) for m in msgs], refused(service.encrypt(pk, bytes(33))),
+                refused(service.encrypt(pk, b"")), refused(service.encrypt(pk, msgs[0], bytes(31))),
+                refused(service.encrypt(pk[:-1], msgs[0])))
+            ok = all(results[n:]) and all(Decrypt(c, sk) == list(m)
+                                          for (c, m) in zip(results[:n], msgs))
+            results = await asyncio.gather(
+                *[service.decrypt(c, sk) for c in cs], refused(service.decrypt(cs[0][:-1], sk)),
+                refused(service.decrypt(cs[0], sk[:-1])))
+            ok = ok and all(results[n:]) and results[:n] == [list(m) for m in msgs]
+            # A malformed item that gets past the checks must fail its batch, not hang it
+            loop = asyncio.get_running_loop()
+            batch = [((c, sk), loop.create_future()) for c in cs[:2]] + [((b"", sk), loop.create_future())]
+            await asyncio.wait_for(service.run("decrypt", batch), 60)
+            if not all(future.done() for (item, future) in batch):
+                return False
+            errors = [future.exception() for (item, future) in batch]
+            return ok and errors[2] is not None
+        finally:
+            await service.close()
+
+    return asyncio.run(check())
+
+# Checks that EnableInstrumentation counts the calls and hashed bytes of PKEGen and calls the hooks,
+# that a failing hook does not break the instrumented call, and that DisableInstrumentation puts
+# the original functions back
+def CheckInstrumentation():
+    if instruments.enabled:
+        return True
+    module = globals()
+    originals = {name: module[name] for names in INSTRUMENTED_STAGES.values() for name in names}
+    calls = []
+    def hook(stage, name, seconds):
+        calls.append((stage, name))
+    def failing(stage, name, seconds):
+        raise RuntimeError("exporter down")
+    instruments.reset()
+    EnableInstrumentation()
+    AddInstrumentationHook(failing)
+    AddInstrumentationHook(hook)
+    logging.disable(logging.ERROR)      # the failures of the hook are expected
+    try:
+        if any(module[name] is fn for (name, fn) in originals.items()):
+            return False
+        pk, sk = PKEGen(bytes(32))
+        snapshot = InstrumentationSnapshot()
+    finally:
+        logging.disable(logging.NOTSET)
+        RemoveInstrumentationHook(failing)
+        RemoveInstrumentationHook(hook)
+        DisableInstrumentation()
+        instruments.reset()
+    functions = snapshot["functions"]
+    return (snapshot["enabled"] and functions["PKEGen"]["calls"] == 1
+            and functions["PKEGen"]["stage"] == "pke" and snapshot["stages"]["pke"]["calls"] == 1
+            and snapshot["hashed_bytes"] > 0 and ("pke", "PKEGen") in calls
+            and len(calls) == sum(f["calls"] for f in functions.values())
+            and not instruments.enabled
+            and all(module[name] is fn for (name, fn) in originals.items()))
+
+# Checks KeyPool with two workers: generate matches PKEGenBatch for the same seeds, encrypt_many and
+# decrypt_many round-trip in input order across several chunks, and empty inputs work
+def CheckKeyPool(n=10):
+    seeds = [os.urandom(32) for _ in range(n)]
+    msgs = [os.urandom(32) for _ in range(n)]
+    coins = [os.urandom(32) for _ in range(n)]
+    with KeyPool(workers=2) as pool:
+        pks, sks = pool.generate(n, seeds)
+        if (pks, sks) != tuple(PKEGenBatch(n, seeds)):
+            return False
+        if pool.generate(0) != ([], []) or pool.encrypt_many(pks[0], [], []) != []:
+            return False
+        if pool.decrypt_many([], sks[0]) != []:
+            return False
+    # The public key is prepared in the workers when they start
+    with KeyPool(workers=2, pks=[pks[0]]) as pool:
+        cs = pool.encrypt_many(pks[0], msgs, coins)
+        if cs != EncryptBatch([pks[0]]*n, msgs, coins):
+            return False
+        return pool.decrypt_many(cs, sks[0]) == [list(m) for m in msgs]
+
+# Checks the Poly operations against the polynomial functions, and that mixing domains and
+# parameter sets is refused
+def CheckPoly(trials=4):
+    for params in (NewHope512, NewHope1024):
+        for _ in range(trials):
+            a = [random.randrange(NEWHOPE_Q) for _ in range(params.n)]
+            b = [random.randrange(NEWHOPE_Q) for _ in range(params.n)]
+            x, y = Poly(a, params=params), Poly(b, params=params)
+            x_hat, y_hat = x.ntt(), y.ntt()
+            product = x_hat * y_hat
+            x_hat *= y_hat
+            if ToList(Poly_mul(NTT(a, params.root), NTT(b, params.root))) != x_hat.tolist():
+                return False
+            if x_hat != product or product.intt().tolist() != ToList(INTT(x_hat.coeffs, params.root)):
+                return False
+            total, difference = x + y, x - y
+            x += y
+            if x.tolist() != ToList(Poly_add(a, b)) or x != total:
+                return False
+            if difference.tolist() != ToList(PolySubtract(a, b)):
+                return False
+            if Poly.from_bytes(x_hat.to_bytes(), params=params) != x_hat:
+                return False
+            if x_hat.view().tolist() != x_hat.tolist():
+                return False
+    x, y = Poly.zeros(), Poly.zeros(POLY_NTT)
+    for op in (lambda: x + y, lambda: x - y, lambda: x * x, lambda: x + Poly.zeros(params=NewHope512),
+               lambda: y.ntt(), lambda: x.intt()):
+        try:
+            op()
+            return False
+        except ValueError:
+            pass
+    # Decoded coefficients above q are reduced, so that in-place arithmetic stays in range
+    y = Poly.from_bytes(b"\xff"*NewHope1024.poly_bytes)
+    if max(y.tolist()) >= NEWHOPE_Q or y.tolist() != [16383 % NEWHOPE_Q]*NEWHOPE_N:
+        return False
+    z = Poly.zeros(POLY_NTT)
+    z -= y
+    if z.tolist() != [(-16383) % NEWHOPE_Q]*NEWHOPE_N:
+        return False
+    view = x.view()
+    view[0] = 7
+    return x[0] == 7 and view.format == "H" and len(view) == NEWHOPE_N
+
+# Checks that the table cache file holds the generated tables, and that a file with a corrupted
+# table, a corrupted directory entry or another version is rebuilt
+def CheckTableCache():
+    previous = os.environ.get("NEWHOPE_TABLE_CACHE")
+    names = StandardTableNames()
+    expected = {name: GenerateTable(name).tolist() for name in names}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.environ["NEWHOPE_TABLE_CACHE"] = os.path.join(tmp, "tables.bin")
+            ResetTables()
+            if GetTable("sample").tolist() != expected["sample"] or not os.path.exists(path):
+                return False
+            ResetTables()
+            if any(GetTable(name).tolist() != expected[name] for name in names):
+                return False
+            if not isinstance(GetTable("compress"), memoryview):
+                return False
+            # Corrupt the first byte of the sample table, the type code of the compress table and
+            # the version number. The warning about the checksum is expected.
+            logging.disable(logging.WARNING)
+            offset = TableCache(path).entries["sample"][1]
+            typecode = (TABLE_CACHE_HEADER.size + sorted(names).index("compress")*TABLE_CACHE_ENTRY.size
+                        + 48)
+            for (position, value, name) in ((offset, b"\xff", "sample"), (typecode, b"Z", "compress"),
+                                            (4, b"\x00\x00", "sample")):
+                ResetTables()
+                with open(path, "r+b") as f:
+                    f.seek(position)
+                    f.write(value)
+                if GetTable(name).tolist() != expected[name]:
+                    return False
+                ResetTables()
+                if TableCache(path).get(name) is None:
+                    return False
+            ResetTables()
+    finally:
+        logging.disable(logging.NOTSET)
+        if previous is None:
+            os.environ.pop("NEWHOPE_TABLE_CACHE", None)
+        else:
+            os.environ["NEWHOPE_TABLE_CACHE"] = previous
+        ResetTables()
+    return True
+
+# Prints the time per item of PKEGenBatch, EncryptBatch and DecryptBatch for growing batch sizes
+def BenchBatch(sizes=(1, 10, 100, 1000)):
+    for n in sizes:
+        msgs = [os.urandom(32) for _ in range(n)]
+        coins = [os.urandom(32) for _ in range(n)]
+
+        start = dt.datetime.now()
+        pks, sks = PKEGenBatch(n)
+        keygen = (dt.datetime.now() - start).total_seconds() / n
+
+        start = dt.datetime.now()
+        cs = EncryptBatch(pks, msgs, coins)
+        enc = (dt.datetime.now() - start).total_seconds() / n
+
+        start = dt.datetime.now()
+        DecryptBatch(cs, sks)
+        dec = (dt.datetime.now() - start).total_seconds() / n
+
+        print("N = {:5d}: PKEGen {:.3f} ms  Encrypt {:.3f} ms  Decrypt {:.3f} ms per item".format(
+            n, keygen*1000, enc*1000, dec*1000))
+
+# Prints the time per polynomial of the original and table-driven samplers
+def BenchSample(iterations=200):
+    seed = os.urandom(32)
+
+    start = dt.datetime.now()
+    for _ in range(iterations):
+        Sample_naive(seed, 0)
+    naive = (dt.datetime.now() - start).total_seconds() / iterations
+
+    start = dt.datetime.now()
+    for _ in range(iterations):
+        Sample(seed, 0)
+    fast = (dt.datetime.now() - start).total_seconds() / iterations
+
+    print("Original Sample: {:.3f} ms per polynomial".format(naive*1000))
+    print("Table Sample:    {:.3f} ms per polynomial ({:.1f}x, {} backend)".format(
+        fast*1000, naive/fast, BACKEND))
+
+# Prints the throughput of KeyPool.generate and KeyPool.decrypt_many for growing worker counts
+def BenchPool(n=2000):
+    counts = sorted({1, 2, 4, 8, 16, 32, os.cpu_count() or 1})
+    for workers in [k for k in counts if k <= (os.cpu_count() or 1)]:
+        with KeyPool(workers) as pool:
+            pool.generate(workers)      # start the workers
+
+            start = time.perf_counter()
+            pks, sks = pool.generate(n)
+            keygen = n/(time.perf_counter() - start)
+
+            pk, sk = pks[0], sks[0]
+            cs = pool.encrypt_many(pk, [os.urandom(32) for _ in range(n)],
+                                   [os.urandom(32) for _ in range(n)])
+            start = time.perf_counter()
+            pool.decrypt_many(cs, sk)
+            dec = n/(time.perf_counter() - start)
+
+        print("{:3d} workers: {:9.1f} key pairs/s  {:9.1f} decryptions/s".format(workers, keygen, dec))
+
+# Compares concurrent decryptions through KEMService one at a time (max_batch 1) and coalesced
+async def BenchAsync(requests=2000, concurrency=256):
+    pk, sk = PKEGen()
+    msgs = [os.urandom(32) for _ in range(requests)]
+    cs = EncryptBatch([pk]*requests, msgs, [os.urandom(32) for _ in range(requests)])
+    for (label, window, max_batch) in [("one at a time", 0, 1), ("coalesced", 0.002, 256)]:
+        service = KEMService(window, max_batch)
+        await service.decrypt(cs[0], sk)     # start the workers
+        latencies = []
+        pending = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with pending:
+                start = time.perf_counter()
+                await service.decrypt(cs[i], sk)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        elapsed = time.perf_counter() - start
+        await service.close()
+        latencies.sort()
+        print("{:<14} {:9.1f} decryptions/s  p50 {:7.2f} ms  p99 {:7.2f} ms".format(
+            label, requests/elapsed, Percentile(latencies, 50)*1000, Percentile(latencies, 99)*1000))
+
+# Prints the throughput of EncryptStream and DecryptStream on temporary files of growing sizes (in
+# MB), with the peak RSS of the process after each size. The peak RSS stays flat because only one
+# chunk is held in memory.
+def BenchStream(sizes=(1, 16, 64, 256)):
+    pk, sk = PKEGen()
+    block = os.urandom(1 << 20)
+    with tempfile.TemporaryDirectory() as tmp:
+        plain, sealed, opened = (os.path.join(tmp, name) for name in ("plain", "sealed", "opened"))
+        for size in sizes:
+            with open(plain, "wb") as f:
+                for _ in range(size):
+                    f.write(block)
+
+            start = time.perf_counter()
+            with open(plain, "rb") as src, open(sealed, "wb") as dst:
+                EncryptStream(pk, src, dst)
+            enc = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with open(sealed, "rb") as src, open(opened, "wb") as dst:
+                DecryptStream(sk, src, dst)
+            dec = time.perf_counter() - start
+
+            rss = ""
+            if resource is not None:
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                if sys.platform == "darwin":
+                    peak //= 1024
+                rss = "  peak RSS {:.1f} MB".format(peak / 1024)
+            print("{:5d} MB: encrypt {:7.1f} MB/s  decrypt {:7.1f} MB/s{}".format(
+                size, size/enc, size/dec, rss))
+
+# Returns the peak and the retained number of bytes allocated by one call of fn
+def TracedBytes(fn):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak - before, current - before
+
+# Prints the bytes allocated and the time per call of the coefficient-wise operations on lists of
+# ints (the pure-Python functions), with the functions of the active backend, and in place on Poly
+def BenchPoly(iterations=1000):
+    a = [random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+    b = [random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+    x, y = Poly(a, POLY_NTT), Poly(b, POLY_NTT)
+    # Adding 0 and multiplying by 1 keep x unchanged over the iterations
+    zero, one = Poly.zeros(POLY_NTT), Poly([1]*NEWHOPE_N, POLY_NTT)
+    def add_in_place():
+        x.__iadd__(zero)
+    def sub_in_place():
+        x.__isub__(zero)
+    def mul_in_place():
+        x.__imul__(one)
+    u, v = AsPoly(a), AsPoly(b)
+    ops = [("add", [("list", lambda: Poly_add_python(a, b)),
+                    (BACKEND, lambda: Poly_add(u, v)),
+                    ("Poly +=", add_in_place)]),
+           ("subtract", [("list", lambda: PolySubtract_python(a, b)),
+                         (BACKEND, lambda: PolySubtract(u, v)),
+                         ("Poly -=", sub_in_place)]),
+           ("multiply", [("list", lambda: Poly_mul_python(a, b)),
+                         (BACKEND, lambda: Poly_mul(u, v)),
+                         ("Poly *=", mul_in_place)])]
+    size = sys.getsizeof(a) + sum(sys.getsizeof(c) for c in a if c > 256)
+    print("One polynomial of {} coefficients: {} B as a list, {} B as a Poly buffer".format(
+        NEWHOPE_N, size, sys.getsizeof(x.coeffs) if BACKEND == "python" else x.coeffs.nbytes))
+    print("{:<10} {:<8} {:>12} {:>14} {:>12}".format("op", "form", "peak bytes", "retained bytes",
+                                                     "us per call"))
+    for (name, forms) in ops:
+        for (form, fn) in forms:
+            peak, retained = TracedBytes(fn)
+            calls = iterations if form != "list" else max(1, iterations//10)
+            start = time.perf_counter()
+            for _ in range(calls):
+                fn()
+            elapsed = (time.perf_counter() - start)/calls
+            print("{:<10} {:<8} {:12d} {:14d} {:12.2f}".format(name, form, peak, retained,
+                                                               elapsed*1e6))
+
+# Startup budget of a short-lived process with a warm table cache: the import of main itself
+# (after NumPy and asyncio, which it imports) and the first PKEGen, which loads the tables
+IMPORT_BUDGET_MS = 40
+FIRST_PKEGEN_BUDGET_MS = 15
+
+# Run in a fresh interpreter by BenchStartup. Prints the seconds taken by the imports of NumPy
+# and asyncio, the import of main, and the first and second PKEGen.
+STARTUP_PROBE = """
+import json, time
+t0 = time.perf_counter()
+import asyncio
+try:
+    import numpy
+except ImportError:
+    pass
+t1 = time.perf_counter()
+import main
+t2 = time.perf_counter()
+main.PKEGen(bytes(32))
+t3 = time.perf_counter()
+main.PKEGen(bytes(32))
+t4 = time.perf_counter()
+print(json.dumps([t1 - t0, t2 - t1, t3 - t2, t4 - t3]))
+"""
+
+# Prints the median startup times of fresh processes with the table cache turned off, with no
+# cache file yet (the first PKEGen generates and writes it) and with the file in place, and
+# whether the warm startup is within the budget
+def BenchStartup(runs=5):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    def probe(cache):
+        env = dict(os.environ, NEWHOPE_TABLE_CACHE=cache)
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE], env=env, cwd=directory,
+                             stdout=subprocess.PIPE, check=True).stdout
+        return json.loads(out)
+    with tempfile.TemporaryDirectory() as tmp:
+        warm = os.path.join(tmp, "warm.bin")
+        probe(warm)
+        modes = [("no cache", lambda i: ""),
+                 ("cold cache", lambda i: os.path.join(tmp, "cold{}.bin".format(i))),
+                 ("warm cache", lambda i: warm)]
+        medians = {}
+        print("{:<12} {:>14} {:>14} {:>14} {:>14}".format("", "NumPy+asyncio", "import main",
+                                                          "first PKEGen", "next PKEGen"))
+        for (name, cache) in modes:
+            columns = zip(*[probe(cache(i)) for i in range(runs)])
+            medians[name] = [sorted(c)[len(c)//2]*1000 for c in columns]
+            print("{:<12} {:11.1f} ms {:11.1f} ms {:11.1f} ms {:11.1f} ms".format(name, *medians[name]))
+    _, import_ms, first_ms, _ = medians["warm cache"]
+    print("Budget: import main {:.1f}/{} ms, first PKEGen {:.1f}/{} ms: {}".format(
+        import_ms, IMPORT_BUDGET_MS, first_ms, FIRST_PKEGEN_BUDGET_MS,
+        "OK" if import_ms <= IMPORT_BUDGET_MS and first_ms <= FIRST_PKEGEN_BUDGET_MS else "OVER"))
+    if sys.dont_write_bytecode:
+        print("Bytecode is not cached (PYTHONDONTWRITEBYTECODE), so main.py is compiled on every import")
+
+# Prints the time per polynomial and the throughput of the original and bulk Compress and
+# Decompress, and of the batched versions
+def BenchCompress(iterations=500, batch=1000):
+    v = [random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+    h = Compress_python(v)
+    fns = [("Compress (original)", Compress_naive, v),
+           ("Compress (python)", Compress_python, v),
+           ("Decompress (original)", Decompress_naive, h),
+           ("Decompress (python)", Decompress_python, h)]
+    if np is not None:
+        vs = np.array([v]*batch, dtype=np.uint16)
+        hs = CompressBatch(vs)
+        fns += [("Compress (numpy)", Compress_numpy, np.array(v, dtype=np.uint16)),
+                ("Decompress (numpy)", Decompress_numpy, h),
+                ("CompressBatch x{}".format(batch), CompressBatch, vs),
+                ("DecompressBatch x{}".format(batch), DecompressBatch, hs)]
+    for (name, fn, arg) in fns:
+        n = batch if "Batch" in name else 1
+        calls = max(1, iterations // n)
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn(arg)
+        elapsed = (time.perf_counter() - start) / (calls*n)
+        print("{:<26} {:9.2f} us per polynomial {:10.1f} MB/s of h".format(
+            name, elapsed*1e6, NEWHOPE_3N_8/elapsed/1e6))
+
+# Prints the append rate, file size and random lookup latency of a key store of n key pairs, and
+# the size of the same keys held as lists of ints. The keys are generated once and appended under
+# different key IDs, so that the timing is of the store and not of PKEGen.
+def BenchKeyStore(n=100000, lookups=10000):
+    pks, sks = PKEGenBatch(1000)
+    # pk and sk as two lists of NEWHOPE_N ints each, most of them too large for the small int cache
+    as_lists = 2*(sys.getsizeof([0]*NEWHOPE_N) + NEWHOPE_N*sys.getsizeof(NEWHOPE_Q))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "keys")
+        with KeyStore(path) as store:
+            start = time.perf_counter()
+            for i in range(0, n, len(pks)):
+                ids = [(i + j).to_bytes(KEYSTORE_ID_BYTES, "big") for j in range(len(pks))]
+                store.extend(pks, sks, ids)
+            append = time.perf_counter() - start
+
+            records = [random.randrange(n) for _ in range(lookups)]
+            start = time.perf_counter()
+            for i in records:
+                store.sk(i)
+            by_record = (time.perf_counter() - start) / lookups
+
+            ids = [i.to_bytes(KEYSTORE_ID_BYTES, "big") for i in records]
+            start = time.perf_counter()
+            for key_id in ids:
+                store.get(key_id)
+            by_id = (time.perf_counter() - start) / lookups
+
+            start = time.perf_counter()
+            for i in records[0:1000]:
+                Decrypt(Encrypt(store.pk(i), bytes(32), bytes(32)), store.sk(i))
+            roundtrip = (time.perf_counter() - start) / 1000
+        size = os.path.getsize(path) + os.path.getsize(path + ".idx")
+
+    print("{} key pairs appended in {:.2f} s ({:.0f} per second)".format(n, append, n/append))
+    print("Store and index: {:.1f} MB, {} bytes per key pair (as lists of ints: {} bytes)".format(
+        size/1e6, size//n, as_lists))
+    print("Lookup by record {:.2f} us, by key ID {:.2f} us, Encrypt+Decrypt from views {:.3f} ms".format(
+        by_record*1e6, by_id*1e6, roundtrip*1000))
+
+# Prints the time of the unfused and fused arithmetic of Encrypt and Decrypt, for each backend
+def BenchFused(iterations=200):
+    polys = [[random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)] for _ in range(4)]
+    backends = [("python", Poly_mul_python, Poly_add_python, PolySubtract_python, INTT_python,
+                 DecodeMsg_python, PolyMulAdd_python, INTTAddCompress_python,
+                 INTTSubtractDecode_python)]
+    if np is not None:
+        backends.append(("numpy", Poly_mul_numpy, Poly_add_numpy, PolySubtract_numpy, INTT_numpy,
+                         DecodeMsg_numpy, PolyMulAdd_numpy, INTTAddCompress_numpy,
+                         INTTSubtractDecode_numpy))
+    for (name, mul, add, sub, intt, decode, mul_add, add_compress, sub_decode) in backends:
+        a, b, e, v = (np.array(x, dtype=np.uint16) if name == "numpy" else x for x in polys)
+        pipelines = [("Encrypt", lambda: (add(mul(a, b), e),
+                                          Compress(add(add(intt(mul(a, b)), e), v))),
+                                 lambda: (mul_add(a, b, e), add_compress(a, b, e, v))),
+                     ("Decrypt", lambda: decode(sub(v, intt(mul(a, b)))),
+                                 lambda: sub_decode(a, b, v))]
+        for (label, unfused, fused) in pipelines:
+            times = []
+            for fn in (unfused, fused):
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    fn()
+                times.append((time.perf_counter() - start) / iterations)
+            print("{:<6} {} arithmetic: unfused {:.3f} ms  fused {:.3f} ms ({:.2f}x)".format(
+                name, label, times[0]*1000, times[1]*1000, times[0]/times[1]))
+
+# Times the naive and fast transforms and prints the time taken per transform
+def BenchNTT(iterations=100):
+    a = [random.randrange(NEWHOPE_Q) for _ in range(NEWHOPE_N)]
+
+    start = dt.datetime.now()
+    NTT_naive(a, NEWHOPE_ROOT, NEWHOPE_Q)
+    naive = (dt.datetime.now() - start).total_seconds()
+
+    start = dt.datetime.now()
+    for _ in range(iterations):
+        NTT_python(a, NEWHOPE_ROOT, NEWHOPE_Q)
+    fast = (dt.datetime.now() - start).total_seconds() / iterations
+
+    start = dt.datetime.now()
+    for _ in range(iterations):
+        INTT_python(a, NEWHOPE_ROOT, NEWHOPE_Q)
+    fast_inv = (dt.datetime.now() - start).total_seconds() / iterations
+
+    print("Naive NTT: {:.3f} ms per transform".format(naive*1000))
+    print("Fast NTT:  {:.3f} ms per transform ({:.0f}x)".format(fast*1000, naive/fast))
+    print("Fast INTT: {:.3f} ms per transform".format(fast_inv*1000))
+
+    if np is not None:
+        start = dt.datetime.now()
+        for _ in range(iterations):
+            NTT_numpy(a)
+        vec = (dt.datetime.now() - start).total_seconds() / iterations
+        print("NumPy NTT: {:.3f} ms per transform ({:.0f}x)".format(vec*1000, naive/vec))
+
+# Runs every check above and prints the results. Returns True if all of them passed.
+def SelfTest():
+    checks = [("NTT/INTT against naive transform", CheckNTT),
+              ("GenA known answer", CheckGenA),
+              ("Sample against original sampler", CheckSample),
+              ("NumPy backend against pure Python", CheckBackend),
+              ("Batched API against single items", CheckBatch),
+              ("Prepared and cached public keys", CheckPublicKeyCache),
+              ("Prepared secret keys", CheckPreparedSecretKey),
+              ("Compress/Decompress round trips", CheckCompress),
+              ("Fused kernels against unfused chains", CheckFused),
+              ("Stream encryption", CheckStream),
+              ("NewHope512 parameter set", CheckParameterSets),
+              ("Key store", CheckKeyStore),
+              ("Failure-rate harness", CheckFailureRate),
+              ("Poly", CheckPoly),
+              ("Table cache", CheckTableCache),
+              ("KEM service", CheckKEMService),
+              ("Instrumentation", CheckInstrumentation),
+              ("Key pool", CheckKeyPool)]
+    passed = True
+    for (name, check) in checks:
+        ok = check()
+        print("{}: {}".format(name, "PASSED" if ok else "FAILED"))
+        passed = passed and ok
+    return passed
+
+# Seed from which the benchmark derives its key seed, message and coin, so runs are comparable
+BENCH_SEED = b"NewHope benchmark seed"
+
+# Returns the value at the given percentile of a sorted list of samples
+def Percentile(samples, pct):
+    k = min(len(samples) - 1, max(0, int(round(pct/100.0*len(samples))) - 1))
+    return samples[k]
+
+# Calls fn warmup times, then times it over the given number of iterations. The peak memory is the
+# largest allocation traced during one extra call, made after the timed ones so that tracing does
+# not slow them down.
+def BenchOp(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    total = sum(samples)
+    return {"iterations": iterations,
+            "ops_per_sec": iterations/total if total > 0 else float("inf"),
+            "mean_ms": total/iterations*1000,
+            "p50_ms": Percentile(samples, 50)*1000,
+            "p95_ms": Percentile(samples, 95)*1000,
+            "p99_ms": Percentile(samples, 99)*1000,
+            "peak_bytes": peak}
+
+# Benchmarks every stage of the pipeline and the whole PKEGen, Encrypt and Decrypt operations
+# with deterministic inputs. Returns a report that can be written as JSON.
+def Bench(iterations=200, warmup=20, params=NewHope1024):
+    z = hashlib.shake_256(BENCH_SEED).digest(128)
+    keyseed, publicseed, noiseseed, m = z[0:32], z[32:64], z[64:96], z[96:128]
+    coin = hashlib.shake_256(z).digest(32)
+
+    pk, sk = PKEGen(keyseed, params)
+    s = Sample(noiseseed, 0, params)
+    s_hat = NTT(s, params.root, params.q)
+    v = Poly_add(INTT(s_hat, params.root, params.q), EncodeMsg(m, params))
+    h = Compress(v)
+    c = Encrypt(pk, m, coin, params)
+
+    ops = [("GenA", lambda: GenA(publicseed, params)),
+           ("Sample", lambda: Sample(noiseseed, 0, params)),
+           ("NTT", lambda: NTT(s, params.root, params.q)),
+           ("INTT", lambda: INTT(s_hat, params.root, params.q)),
+           ("EncodePoly", lambda: EncodePoly(s_hat)),
+           ("DecodePoly", lambda: DecodePoly(sk)),
+           ("Compress", lambda: Compress(v)),
+           ("Decompress", lambda: Decompress(h)),
+           ("PKEGen", lambda: PKEGen(keyseed, params)),
+           ("PreparePublicKey", lambda: PreparePublicKey(pk, params)),
+           ("Encrypt", lambda: Encrypt(pk, m, coin, params)),
+           ("Decrypt", lambda: Decrypt(c, sk, params))]
+
+    results = {}
+    for (name, fn) in ops:
+        results[name] = BenchOp(fn, iterations, warmup)
+
+    return {"version": 1,
+            "timestamp": dt.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": BACKEND,
+            "params": params.name,
+            "iterations": iterations,
+            "warmup": warmup,
+            "results": results}
+
+# Prints a benchmark report as a table
+def PrintBench(report):
+    print("Parameters: {}  Backend: {}  Python: {}  Iterations: {}  Warm-up: {}".format(
+        report.get("params", NewHope1024.name), report["backend"], report["python"],
+        report["iterations"], report["warmup"]))
+    print("{:<18}{:>12}{:>10}{:>10}{:>10}{:>12}".format("Operation", "ops/sec", "p50 ms", "p95 ms",
+                                                       "p99 ms", "peak KiB"))
+    for (name, r) in report["results"].items():
+        print("{:<18}{:>12.1f}{:>10.3f}{:>10.3f}{:>10.3f}{:>12.1f}".format(
+            name, r["ops_per_sec"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["peak_bytes"]/1024))
+
+# Runs Bench for every parameter set and prints the throughput of each operation side by side,
+# with the key and ciphertext sizes
+def BenchParams(iterations=200, warmup=20):
+    sets = list(PARAMETER_SETS.values())
+    reports = [Bench(iterations, warmup, params) for params in sets]
+    print("{:<18}".format("ops/sec") + "".join("{:>14}".format(p.name) for p in sets)
+          + "{:>10}".format("ratio"))
+    for name in reports[0]["results"]:
+        rates = [report["results"][name]["ops_per_sec"] for report in reports]
+        print("{:<18}".format(name) + "".join("{:>14.1f}".format(r) for r in rates)
+              + "{:>9.2f}x".format(rates[0]/rates[-1]))
+    for (label, attr) in [("public key bytes", "pk_bytes"), ("secret key bytes", "sk_bytes"),
+                          ("ciphertext bytes", "ct_bytes")]:
+        print("{:<18}".format(label) + "".join("{:>14d}".format(getattr(p, attr)) for p in sets))
+
 # Driver for key creation, encryption and decryption
 def main():
     print("=============================================================================")
@@ -513,7 +3625,133 @@ def main():
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        if str(sys.argv[1]).lower() == "debug":
-            logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-    main()
+    parser = argparse.ArgumentParser(description="NewHope key generation, encryption and decryption")
+    modes = parser.add_subparsers(dest="mode")
+    modes.add_parser("debug", help="run the example and print the per-stage counters and timings")
+    modes.add_parser("selftest", help="check the fast paths against the reference implementations")
+    bench = modes.add_parser("bench", help="measure the throughput and latency of every stage")
+    bench_params = modes.add_parser("bench-params", help="compare the parameter sets")
+    for p in (bench, bench_params):
+        p.add_argument("--iterations", type=int, default=200, help="timed calls per operation")
+        p.add_argument("--warmup", type=int, default=20, help="untimed calls per operation")
+    bench.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    modes.add_parser("bench-ntt", help="compare the naive and fast NTT")
+    modes.add_parser("bench-batch", help="time the batched API for growing batch sizes")
+    modes.add_parser("bench-sample", help="compare the original and table-driven Sample")
+    modes.add_parser("bench-pool", help="time the process pool for growing worker counts")
+    modes.add_parser("bench-async", help="compare coalesced and one-at-a-time async decryption")
+    modes.add_parser("bench-stream", help="time stream encryption for growing file sizes")
+    modes.add_parser("bench-fused", help="compare the fused and unfused Encrypt/Decrypt arithmetic")
+    modes.add_parser("bench-compress", help="compare the original and bulk Compress/Decompress")
+    modes.add_parser("bench-keystore", help="time appends and lookups in the key store")
+    modes.add_parser("bench-poly", help="compare allocations of list and in-place Poly arithmetic")
+    modes.add_parser("bench-startup", help="time the import and the first PKEGen of fresh processes")
+    failure = modes.add_parser("failure-rate", help="estimate the decryption failure rate")
+    failure.add_argument("--trials", type=int, default=100000, help="encrypt/decrypt trials")
+    failure.add_argument("--seed", default="", help="run seed (any string)")
+    failure.add_argument("--workers", type=int, help="worker processes (default: CPU count)")
+    failure.add_argument("--chunk", type=int, default=1000, help="trials per chunk")
+    failure.add_argument("--out", metavar="PATH", help="results file, resumed if it exists")
+    keygen = modes.add_parser("keygen", help="write a new key pair to two files")
+    keygen.add_argument("pk", help="public key file")
+    keygen.add_argument("sk", help="secret key file")
+    for (name, key, what) in [("encrypt-stream", "pk", "encrypt a file or stdin to a public key"),
+                              ("decrypt-stream", "sk", "decrypt a file or stdin with a secret key")]:
+        p = modes.add_parser(name, help=what)
+        p.add_argument(key, help="{} key file".format("public" if key == "pk" else "secret"))
+        p.add_argument("input", nargs="?", help="input file (default: stdin)")
+        p.add_argument("output", nargs="?", help="output file (default: stdout)")
+    serve = modes.add_parser("serve", help="run the demo KEM server")
+    loadgen = modes.add_parser("loadgen", help="send requests to the demo KEM server")
+    for p in (serve, loadgen):
+        p.add_argument("--host", default="127.0.0.1")
+        p.add_argument("--port", type=int, default=8765)
+        p.add_argument("--unix", metavar="PATH", help="use a Unix socket instead of TCP")
+    serve.add_argument("--window-ms", type=float, default=2.0, help="coalescing window")
+    serve.add_argument("--max-batch", type=int, default=256, help="largest coalesced batch")
+    serve.add_argument("--workers", type=int, help="worker processes (default: CPU count)")
+    loadgen.add_argument("--clients", type=int, default=64, help="concurrent connections")
+    loadgen.add_argument("--requests", type=int, default=4000, help="total requests")
+    for p in modes.choices.values():
+        p.add_argument("--params", choices=sorted(PARAMETER_SETS), default=NewHope1024.name,
+                       help="parameter set (default: %(default)s)")
+    args = parser.parse_args()
+    params = GetParameterSet(getattr(args, "params", NewHope1024.name))
+
+    if args.mode == "selftest":
+        sys.exit(0 if SelfTest() else 1)
+    elif args.mode == "bench":
+        report = Bench(args.iterations, args.warmup, params)
+        PrintBench(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    elif args.mode == "bench-params":
+        BenchParams(args.iterations, args.warmup)
+    elif args.mode == "bench-ntt":
+        BenchNTT()
+    elif args.mode == "bench-batch":
+        BenchBatch()
+    elif args.mode == "bench-sample":
+        BenchSample()
+    elif args.mode == "bench-pool":
+        BenchPool()
+    elif args.mode == "bench-async":
+        asyncio.run(BenchAsync())
+    elif args.mode == "bench-stream":
+        BenchStream()
+    elif args.mode == "bench-fused":
+        BenchFused()
+    elif args.mode == "bench-compress":
+        BenchCompress()
+    elif args.mode == "bench-keystore":
+        BenchKeyStore()
+    elif args.mode == "bench-poly":
+        BenchPoly()
+    elif args.mode == "bench-startup":
+        BenchStartup()
+    elif args.mode == "failure-rate":
+        def progress(chunks, elapsed, new_trials):
+            done = sum(record["trials"] for record in chunks)
+            failures = sum(record["failures"] for record in chunks)
+            print("\r{}/{} trials, {} failures, {:.1f} trials/s".format(
+                done, args.trials, failures, new_trials/elapsed), end="", file=sys.stderr)
+        summary = FailureRate(args.trials, args.seed.encode(), params, args.workers, args.chunk,
+                              args.out, progress)
+        print(file=sys.stderr)
+        PrintFailureRate(summary)
+    elif args.mode == "keygen":
+        pk, sk = PKEGen(params=params)
+        with open(args.pk, "wb") as f:
+            f.write(pk)
+        with open(args.sk, "wb") as f:
+            f.write(sk)
+    elif args.mode in ("encrypt-stream", "decrypt-stream"):
+        with open(args.pk if args.mode == "encrypt-stream" else args.sk, "rb") as f:
+            key = f.read()
+        src = open(args.input, "rb") if args.input else sys.stdin.buffer
+        dst = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            if args.mode == "encrypt-stream":
+                EncryptStream(key, src, dst, params=params)
+            else:
+                DecryptStream(key, src, dst, params)
+        except ValueError as e:
+            sys.exit("{}: {}".format(args.mode, e))
+        finally:
+            if args.input:
+                src.close()
+            if args.output:
+                dst.close()
+    elif args.mode == "serve":
+        asyncio.run(Serve(args.host, args.port, args.unix, args.window_ms/1000, args.max_batch,
+                          args.workers, params))
+    elif args.mode == "loadgen":
+        asyncio.run(LoadGen(args.host, args.port, args.unix, args.clients, args.requests, params))
+    elif args.mode == "debug":
+        logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+        EnableInstrumentation()
+        main()
+        PrintInstrumentation(InstrumentationSnapshot())
+    else:
+        main()